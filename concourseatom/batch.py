@@ -0,0 +1,143 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Merge many sets of pipeline snippets into many pipelines across processes
+"""
+
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+import os
+import time
+from typing import Dict, List, Optional
+
+from ruamel.yaml import YAML
+
+from concourseatom.models import Pipeline
+from concourseatom.timing import phase, phase_hook
+from concourseatom.trace import TraceEvent, Tracer
+
+
+@dataclass
+class BatchResult:
+    """Outcome of merging the inputs of one output pipeline
+
+    :param output: Path the merged pipeline was written to
+    :param inputs: Number of snippets merged
+    :param parse_seconds: Time to read and parse the snippets
+    :param merge_seconds: Time to validate and merge the snippets
+    :param write_seconds: Time to serialise and write the output
+    :param trace_events: Spans of the phases of the merge when traced, see
+        :mod:`concourseatom.trace`
+    """
+
+    output: str
+    inputs: int
+    parse_seconds: float
+    merge_seconds: float
+    write_seconds: float
+    trace_events: List[TraceEvent] = field(default_factory=list)
+
+
+def load_manifest(manifest_file: str) -> Dict[str, List[str]]:
+    """Load a batch manifest mapping output pipelines to input snippets
+
+    The manifest is YAML (or JSON) of the form::
+
+        team-a.yaml:
+        - snippets/git.yaml
+        - snippets/build.yaml
+
+    Relative paths are resolved from the directory containing the manifest.
+    """
+    with open(manifest_file, "rb") as f:
+        manifest = YAML(typ="safe").load(f) or {}
+
+    if not isinstance(manifest, dict) or not all(
+        isinstance(inputs, list) for inputs in manifest.values()
+    ):
+        raise Exception(
+            f"Manifest must map outputs to lists of inputs: {manifest_file}"
+        )
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    return {
+        os.path.join(base_dir, output): [
+            os.path.join(base_dir, input) for input in inputs
+        ]
+        for output, inputs in manifest.items()
+    }
+
+
+def merge_files(
+    output: str,
+    inputs: List[str],
+    deep: bool = False,
+    compact: bool = False,
+    trace: bool = False,
+) -> BatchResult:
+    """Merge input files in order and write the merged pipeline to output
+
+    With compact fields holding their default value are left out of the output.
+    With trace the phases of the merge are recorded in the result.
+    """
+    tracer = Tracer()
+    with ExitStack() as stack:
+        if trace:
+            stack.enter_context(phase_hook(tracer))
+        stack.enter_context(phase("batch", output=output, inputs=len(inputs)))
+
+        start = time.perf_counter()
+        pipelines = []
+        for input in inputs:
+            with open(input, "rb") as f:
+                pipelines.append(Pipeline.parse_any(f.read()))
+        parsed = time.perf_counter()
+
+        merged = Pipeline.merge_many(pipelines, deep=deep)
+        merged_time = time.perf_counter()
+
+        # As concmerge merge -o writes, so both give the same bytes
+        with open(output, "w", encoding="utf-8", newline="") as f:
+            merged.write(f, compact=compact)
+        written = time.perf_counter()
+
+    return BatchResult(
+        output=output,
+        inputs=len(inputs),
+        parse_seconds=parsed - start,
+        merge_seconds=merged_time - parsed,
+        write_seconds=written - merged_time,
+        trace_events=tracer.events,
+    )
+
+
+def merge_batch(
+    manifest: Dict[str, List[str]],
+    deep: bool = False,
+    workers: Optional[int] = None,
+    compact: bool = False,
+    trace: bool = False,
+) -> List[BatchResult]:
+    """Merge every output of a manifest using a pool of processes
+
+    Each output is merged independently from its own inputs so the files written do
+    not depend on the number of workers. Results are returned in manifest order.
+
+    :param manifest: Output path to ordered list of input paths
+    :param deep: Deep merge jobs of the same name
+    :param workers: Number of processes, defaults to the number of CPUs. With a
+        single worker the merges run in this process.
+    :param compact: Leave fields holding their default value out of the outputs
+    :param trace: Record the phases of each merge in its result
+    """
+    outputs = list(manifest)
+    inputs = [manifest[output] for output in outputs]
+    deeps = [deep] * len(outputs)
+    compacts = [compact] * len(outputs)
+    traces = [trace] * len(outputs)
+
+    if workers == 1 or len(outputs) <= 1:
+        return list(map(merge_files, outputs, inputs, deeps, compacts, traces))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(merge_files, outputs, inputs, deeps, compacts, traces))
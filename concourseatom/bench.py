@@ -0,0 +1,278 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Benchmark the phases of loading and merging pipelines
+
+Each phase is timed on synthetic pipelines from :mod:`concourseatom.synth` at a
+number of scales, the scale being the number of jobs in each input. Results can be
+saved as JSON and compared with a baseline saved earlier to catch regressions.
+"""
+
+from __future__ import annotations
+from dataclasses import asdict, dataclass, replace
+from functools import cached_property
+import gc
+import json
+import math
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterable, List, Optional, TextIO, Tuple
+
+from concourseatom.models import Job, Pipeline, Resource, ResourceType
+from concourseatom.synth import SynthConfig, synth_data
+
+DEFAULT_SCALES = (10, 100)
+
+# Differences smaller than these are noise rather than regressions, however large
+# they are relative to the baseline of a very quick phase
+_NOISE = {"p50_seconds": 0.001, "peak_bytes": 64 * 1024}
+
+
+@dataclass
+class BenchResult:
+    """Timings of one phase at one scale
+
+    :param phase: Name of the phase, one of :data:`PHASES`
+    :param scale: Number of jobs in each input
+    :param runs: Number of timed runs
+    :param ops_per_second: Runs per second over all the timed runs
+    :param p50_seconds: Median time of a run
+    :param p95_seconds: 95th percentile time of a run
+    :param peak_bytes: Peak memory allocated during a run
+    """
+
+    phase: str
+    scale: int
+    runs: int
+    ops_per_second: float
+    p50_seconds: float
+    p95_seconds: float
+    peak_bytes: int
+
+
+class _Inputs:
+    """Two synthetic pipelines to merge, built on first use"""
+
+    def __init__(self, scale: int):
+        config = SynthConfig(
+            resource_types=max(1, scale // 20),
+            resources=max(1, scale // 4),
+            jobs=scale,
+            collision_rate=0.2,
+            duplicate_rate=0.2,
+        )
+        self.left_data = synth_data(config)
+        self.right_data = synth_data(replace(config, seed=1))
+
+    @cached_property
+    def left_json(self) -> str:
+        return json.dumps(self.left_data)
+
+    @cached_property
+    def right_json(self) -> str:
+        return json.dumps(self.right_data)
+
+    @cached_property
+    def left(self) -> Pipeline:
+        return Pipeline.parse_obj(self.left_data)
+
+    @cached_property
+    def left_yaml(self) -> str:
+        return self.left.yaml()
+
+    def fresh(self) -> Tuple[Pipeline, Pipeline]:
+        """New instances of the inputs, without any cached fingerprints"""
+        left = Pipeline.load_trusted(self.left_json)
+        right = Pipeline.load_trusted(self.right_json)
+        return left, right
+
+
+# Each phase prepares a call to time from the inputs. Preparing is not timed and is
+# repeated for every run so runs start from new objects rather than warm caches.
+PHASES: Dict[str, Callable[[_Inputs], Callable[[], Any]]] = {}
+
+
+def _phase(name: str):
+    def register(prepare: Callable[[_Inputs], Callable[[], Any]]):
+        PHASES[name] = prepare
+        return prepare
+
+    return register
+
+
+@_phase("parse")
+def _parse(inputs: _Inputs) -> Callable[[], Any]:
+    text = inputs.left_yaml
+    return lambda: Pipeline.parse_raw(text)
+
+
+@_phase("parse:json")
+def _parse_json(inputs: _Inputs) -> Callable[[], Any]:
+    text = inputs.left_json
+    return lambda: Pipeline.parse_any(text)
+
+
+@_phase("parse:trusted")
+def _parse_trusted(inputs: _Inputs) -> Callable[[], Any]:
+    text = inputs.left_json
+    return lambda: Pipeline.load_trusted(text)
+
+
+@_phase("validate")
+def _validate(inputs: _Inputs) -> Callable[[], Any]:
+    left, _ = inputs.fresh()
+    return left.validate
+
+
+def _uniques_and_rewrites(cls: type, field: str):
+    def prepare(inputs: _Inputs) -> Callable[[], Any]:
+        left, right = inputs.fresh()
+        return lambda: cls.uniques_and_rewrites(
+            getattr(left, field), getattr(right, field)
+        )
+
+    return prepare
+
+
+for _cls, _field in [
+    (ResourceType, "resource_types"),
+    (Resource, "resources"),
+    (Job, "jobs"),
+]:
+    _phase(f"uniques_and_rewrites:{_cls.__name__}")(_uniques_and_rewrites(_cls, _field))
+
+
+@_phase("merge")
+def _merge(inputs: _Inputs) -> Callable[[], Any]:
+    left, right = inputs.fresh()
+    return lambda: Pipeline.merge(left, right)
+
+
+@_phase("merge:deep")
+def _merge_deep(inputs: _Inputs) -> Callable[[], Any]:
+    left, right = inputs.fresh()
+    return lambda: Pipeline.merge(left, right, deep=True)
+
+
+@_phase("eq")
+def _eq(inputs: _Inputs) -> Callable[[], Any]:
+    left, _ = inputs.fresh()
+    other, _ = inputs.fresh()
+    return lambda: left == other
+
+
+@_phase("exactEq")
+def _exact_eq(inputs: _Inputs) -> Callable[[], Any]:
+    left, _ = inputs.fresh()
+    other, _ = inputs.fresh()
+    return lambda: left.exactEq(other)
+
+
+@_phase("yaml")
+def _yaml(inputs: _Inputs) -> Callable[[], Any]:
+    return inputs.left.yaml
+
+
+def _percentile(times: List[float], percent: float) -> float:
+    """Nearest rank percentile of sorted times"""
+    return times[max(0, math.ceil(len(times) * percent / 100) - 1)]
+
+
+def run_phase(phase: str, inputs: _Inputs, scale: int, runs: int) -> BenchResult:
+    """Time runs of phase and measure the peak memory of one more run"""
+    prepare = PHASES[phase]
+    times = []
+    for _ in range(runs):
+        call = prepare(inputs)
+        gc.collect()
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+
+    # Tracing slows everything down so memory is measured apart from the timing
+    call = prepare(inputs)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        call()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    return BenchResult(
+        phase=phase,
+        scale=scale,
+        runs=runs,
+        ops_per_second=runs / sum(times) if sum(times) else math.inf,
+        p50_seconds=_percentile(times, 50),
+        p95_seconds=_percentile(times, 95),
+        peak_bytes=peak_bytes,
+    )
+
+
+def run_benchmarks(
+    scales: Iterable[int] = DEFAULT_SCALES,
+    phases: Optional[Iterable[str]] = None,
+    runs: int = 3,
+    on_result: Callable[[BenchResult], None] = lambda result: None,
+) -> List[BenchResult]:
+    """Run every phase at every scale
+
+    :param scales: Numbers of jobs in each input
+    :param phases: Names of the phases to run, defaults to all of :data:`PHASES`
+    :param runs: Number of timed runs of each phase at each scale
+    :param on_result: Called with each result as soon as it is ready
+    """
+    phases = list(PHASES) if phases is None else list(phases)
+    for phase in phases:
+        if phase not in PHASES:
+            raise Exception(f"Unknown benchmark phase {phase}")
+
+    results = []
+    for scale in scales:
+        inputs = _Inputs(scale)
+        for phase in phases:
+            result = run_phase(phase, inputs, scale, runs)
+            on_result(result)
+            results.append(result)
+    return results
+
+
+def dump_results(results: List[BenchResult], stream: TextIO) -> None:
+    json.dump({"results": [asdict(result) for result in results]}, stream, indent=2)
+    stream.write("\n")
+
+
+def load_results(stream: TextIO) -> List[BenchResult]:
+    return [BenchResult(**result) for result in json.load(stream)["results"]]
+
+
+def compare(
+    results: List[BenchResult], baseline: List[BenchResult], threshold: float = 0.25
+) -> List[str]:
+    """Describe each phase that regressed from baseline by more than threshold
+
+    A phase regresses when its median time or peak memory grows by more than the
+    fraction threshold of the baseline, and by more than the noise in the
+    measurement (a millisecond or 64KiB). Phases and scales missing from baseline
+    are not compared.
+
+    :return: A description of each regression, empty when there are none
+    """
+    baselines = {(result.phase, result.scale): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baselines.get((result.phase, result.scale))
+        if base is None:
+            continue
+        for measure, unit in [("p50_seconds", "s"), ("peak_bytes", " bytes")]:
+            value, base_value = getattr(result, measure), getattr(base, measure)
+            if (
+                value > base_value * (1 + threshold)
+                and value - base_value > _NOISE[measure]
+            ):
+                regressions.append(
+                    f"{result.phase} at scale {result.scale}: {measure} {value:.6g}"
+                    f"{unit} is more than {threshold:.0%} above the baseline"
+                    f" {base_value:.6g}{unit}"
+                )
+    return regressions
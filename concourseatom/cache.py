@@ -0,0 +1,349 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Cache parsed and merged pipelines keyed by the content of their source
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+import hashlib
+from importlib import metadata
+from io import StringIO
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from typing import IO, Any, Callable, Hashable, List, Optional, TextIO, Tuple
+
+import pydantic
+
+from concourseatom import models
+from concourseatom.models import Pipeline
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir() -> str:
+    """Directory used for the cache when none is given
+
+    ``$CONCOURSEATOM_CACHE_DIR`` if set, otherwise ``concourseatom`` under
+    ``$XDG_CACHE_HOME`` or ``~/.cache``.
+    """
+    if os.environ.get("CONCOURSEATOM_CACHE_DIR"):
+        return os.environ["CONCOURSEATOM_CACHE_DIR"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "concourseatom")
+
+
+def _library_version() -> str:
+    """Identify the code that defines the cached models
+
+    The package version is not enough for development installs so the source of the
+    models is included too.
+    """
+    try:
+        version = metadata.version("concourseatom")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+    with open(models.__file__, "rb") as f:
+        source = hashlib.sha256(f.read()).hexdigest()
+    return f"{version}:{source}:{pydantic.VERSION}"
+
+
+def _loader_name(loader: Callable[[bytes], Pipeline]) -> str:
+    return f"{loader.__module__}.{loader.__qualname__}"
+
+
+class ParseCache:
+    """Content addressed on disk cache of parsed pipelines
+
+    Entries are the JSON of Pipelines stored under a hash of the input bytes, the
+    library version and the loader, so a change to any of them is a miss. They are
+    read back with :meth:`Pipeline.load_trusted`, so an entry can only ever hold
+    data, never code. Hits refresh the modification time of the entry and the least
+    recently used entries are removed once the cache grows beyond max_bytes.
+    Unreadable entries are treated as misses so a corrupt or stale cache never fails
+    a load.
+
+    Entries are trusted, so a directory owned by another user or writable by
+    anyone else is refused with :class:`PermissionError`.
+
+    :param directory: Where entries are stored, created private to the user if
+        missing
+    :param max_bytes: Size the cache is trimmed to after each new entry
+    """
+
+    _suffixes: Tuple[str, ...] = (".json",)
+
+    def __init__(
+        self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self._version = _library_version()
+        self._checked = False
+
+    def key(self, data: bytes, loader: Callable[[bytes], Pipeline]) -> str:
+        return self._digest(_loader_name(loader).encode(), data)
+
+    def _digest(self, *parts: bytes) -> str:
+        digest = hashlib.sha256()
+        for part in (self._version.encode(), *parts):
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key: str, suffix: str = ".json") -> str:
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def _check_directory(self) -> None:
+        """Create the directory or check that only this user can change it"""
+        if self._checked:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if hasattr(os, "getuid"):
+            info = os.stat(self.directory)
+            if info.st_uid != os.getuid():
+                raise PermissionError(
+                    f"Cache directory {self.directory} is owned by another user"
+                )
+            if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise PermissionError(
+                    f"Cache directory {self.directory} is writable by other users"
+                )
+        self._checked = True
+
+    def _read(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write(self, path: str, write: Callable[[IO], None], mode: str = "wb") -> None:
+        self._check_directory()
+        # Write then rename so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            if "b" in mode:
+                f = os.fdopen(fd, mode)
+            else:
+                f = os.fdopen(fd, mode, encoding="utf-8", newline="")
+            with f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._discard(tmp_path)
+            raise
+        self.evict()
+
+    def get(self, key: str) -> Optional[Pipeline]:
+        self._check_directory()
+        path = self._path(key)
+        data = self._read(path)
+        if data is None:
+            return None
+        try:
+            # Anything other than a JSON object would be read as YAML
+            if not data.startswith(b"{"):
+                raise ValueError(f"Cache entry {path} is not JSON")
+            return Pipeline.load_trusted(data)
+        except Exception:
+            self._discard(path)
+            return None
+
+    def put(self, key: str, pipeline: Pipeline) -> None:
+        self._write(self._path(key), pipeline.write_json, "w")
+
+    def load(
+        self,
+        data: bytes,
+        loader: Callable[[bytes], Pipeline] = Pipeline.parse_raw,
+    ) -> Pipeline:
+        """Return the Pipeline loader makes of data, from the cache when possible"""
+        key = self.key(data, loader)
+        pipeline = self.get(key)
+        if pipeline is None:
+            pipeline = loader(data)
+            self.put(key, pipeline)
+        return pipeline
+
+    def evict(self) -> None:
+        """Remove least recently used entries until within max_bytes"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self._suffixes):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._discard(path)
+            total -= size
+
+    @staticmethod
+    def _discard(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class MergeCache(ParseCache):
+    """On disk cache of merged pipelines as YAML or JSON with their parsed inputs
+
+    A merge is a pure function of its inputs, their order and the deep flag, so the
+    YAML of a merge is stored under a hash of the bytes of every input in order along
+    with the loader, the flag and the output format. A hit returns the stored output
+    without parsing or merging anything. Misses parse through the cache
+    of :class:`ParseCache`.
+    """
+
+    _suffixes = (".json", ".yaml")
+
+    def merge_key(
+        self,
+        inputs: List[bytes],
+        deep: bool,
+        loader: Callable[[bytes], Pipeline],
+        compact: bool = False,
+        output_format: str = "yaml",
+    ) -> str:
+        return self._digest(
+            _loader_name(loader).encode(),
+            str(deep).encode(),
+            str(compact).encode(),
+            output_format.encode(),
+            *(self.key(data, loader).encode() for data in inputs),
+        )
+
+    def merge_yaml(
+        self,
+        inputs: List[bytes],
+        deep: bool = False,
+        loader: Callable[[bytes], Pipeline] = Pipeline.parse_raw,
+        compact: bool = False,
+    ) -> str:
+        """Return the YAML of the merge of inputs, from the cache when possible"""
+        output = StringIO()
+        self.write_merge(inputs, output, deep, loader, compact)
+        return output.getvalue()
+
+    def write_merge(
+        self,
+        inputs: List[bytes],
+        output: TextIO,
+        deep: bool = False,
+        loader: Callable[[bytes], Pipeline] = Pipeline.parse_raw,
+        compact: bool = False,
+        output_format: str = "yaml",
+    ) -> None:
+        """Write the merge of inputs to output, from the cache when possible
+
+        The output is streamed into the cache and copied from there to output so it
+        is never held in memory as a whole. See :meth:`Pipeline.write` for compact
+        and output_format.
+        """
+        self._check_directory()
+        path = self._path(
+            self.merge_key(inputs, deep, loader, compact, output_format),
+            f".{output_format}",
+        )
+        try:
+            cached = open(path, encoding="utf-8", newline="")
+        except FileNotFoundError:
+            pipelines = [self.load(data, loader) for data in inputs]
+            merged = Pipeline.merge_many(pipelines, deep=deep)
+            self._write(path, lambda f: merged.write(f, output_format, compact), "w")
+            try:
+                cached = open(path, encoding="utf-8", newline="")
+            except FileNotFoundError:
+                # Larger than the whole cache so it was evicted straight away
+                merged.write(output, output_format, compact)
+                return
+        else:
+            os.utime(path)
+
+        with cached:
+            shutil.copyfileobj(cached, output)
+
+
+class LRUCache:
+    """Thread safe in process least recently used cache
+
+    :param maxsize: Number of entries to keep
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class MergeMemo:
+    """In process least recently used cache of merged pipelines
+
+    Merges are keyed by the :meth:`Pipeline.exact_key` of each input so only inputs
+    with exactly the same content share a result. Equality of pipelines is not enough
+    as it ignores fields, such as job hooks, that change the output. The key is
+    cached on the input so passing the same objects again is cheap. Building it for
+    a freshly parsed input walks every field, which takes around half as long as a
+    merge, so the memo saves less for inputs parsed again each time. Results are
+    shared between callers, like the sub-models a merge shares with its inputs, so
+    they must not be modified.
+
+    :param maxsize: Number of merges to keep
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self._results = LRUCache(maxsize)
+
+    @staticmethod
+    def _key(pipelines: List[Pipeline], deep: bool) -> Hashable:
+        return (deep, tuple(pipeline.exact_key() for pipeline in pipelines))
+
+    def merge_many(self, pipelines: List[Pipeline], deep: bool = False) -> Pipeline:
+        """Cached :meth:`Pipeline.merge_many`"""
+        key = self._key(pipelines, deep)
+        merged = self._results.get(key)
+        if merged is None:
+            merged = Pipeline.merge_many(pipelines, deep=deep)
+            self._results.put(key, merged)
+        return merged
+
+    def merge(self, left: Pipeline, right: Pipeline, deep: bool = False) -> Pipeline:
+        """Cached :meth:`Pipeline.merge`"""
+        return self.merge_many([left, right], deep)
+
+    def clear(self) -> None:
+        self._results.clear()
@@ -0,0 +1,126 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Client for merges served by ``concmerge serve``
+
+Only uses the standard library so a client does not pay for importing the models.
+
+Requests and responses are sequences of frames, each a 4 byte big endian length
+followed by that many bytes. A request is a JSON header frame, with ``deep``,
+``trusted``, ``compact``, ``format`` and the number of ``inputs``, followed by one
+frame per input file. A response is a JSON header frame, with ``ok`` and on
+failure ``error``, followed on success by a frame of the merged pipeline.
+"""
+
+from __future__ import annotations
+import json
+import os
+import socket
+import stat
+import struct
+import tempfile
+from typing import Any, Dict, List, Optional
+
+_LENGTH = struct.Struct(">I")
+
+
+class MergeServerError(Exception):
+    """A merge failed in the server"""
+
+
+def default_socket_path() -> str:
+    """Socket used when none is given
+
+    ``$CONCOURSEATOM_SOCKET`` if set, otherwise ``concourseatom.sock`` in
+    ``$XDG_RUNTIME_DIR`` or, without one, in a directory private to the user in the
+    temporary directory. Anyone can create files in the temporary directory so the
+    private directory is created if missing and refused if another user can change
+    it.
+    """
+    if os.environ.get("CONCOURSEATOM_SOCKET"):
+        return os.environ["CONCOURSEATOM_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "concourseatom.sock")
+    directory = os.path.join(tempfile.gettempdir(), f"concourseatom-{os.getuid()}")
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError(f"{directory} is not a directory private to this user")
+    return os.path.join(directory, "merge.sock")
+
+
+def send_frame(sock: socket.socket, data: bytes) -> None:
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed mid frame")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    (size,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return _recv_exactly(sock, size)
+
+
+def send_json(sock: socket.socket, header: Dict[str, Any]) -> None:
+    send_frame(sock, json.dumps(header).encode())
+
+
+def recv_json(sock: socket.socket) -> Dict[str, Any]:
+    return json.loads(recv_frame(sock))
+
+
+def merge_remote(
+    inputs: List[bytes],
+    deep: bool = False,
+    trusted: bool = False,
+    socket_path: Optional[str] = None,
+    compact: bool = False,
+    output_format: str = "yaml",
+) -> str:
+    """Merge the content of input files in a running server
+
+    :param inputs: Content of the files to merge in priority order
+    :param deep: Deep merge jobs of the same name
+    :param trusted: Skip validation of the inputs
+    :param socket_path: Socket of the server, see :func:`default_socket_path`
+    :param compact: Leave fields holding their default value out of the output
+    :param output_format: ``yaml`` or ``json``
+    :return: The merged pipeline in output_format
+    :raises PermissionError: The socket belongs to another user, who would see
+        the inputs
+    """
+    socket_path = socket_path or default_socket_path()
+    if os.stat(socket_path).st_uid != os.getuid():
+        raise PermissionError(f"{socket_path} is owned by another user")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        send_json(
+            sock,
+            {
+                "deep": deep,
+                "trusted": trusted,
+                "compact": compact,
+                "format": output_format,
+                "inputs": len(inputs),
+            },
+        )
+        for data in inputs:
+            send_frame(sock, data)
+
+        response = recv_json(sock)
+        if not response.get("ok"):
+            raise MergeServerError(response.get("error", "Unknown error"))
+        return recv_frame(sock).decode()
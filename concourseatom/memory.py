@@ -0,0 +1,117 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Measure the memory used by the phases of merges
+
+A :class:`MemoryTracker` installed with :func:`concourseatom.timing.phase_hook`
+records the peak memory allocated within each phase with :mod:`tracemalloc`, which
+must be tracing. :func:`live_models` counts the model instances alive, which shows
+how much of a pipeline is copied rather than shared.
+"""
+
+from __future__ import annotations
+from collections import Counter
+from contextlib import contextmanager
+import gc
+import tracemalloc
+from typing import Any, Dict, List, Tuple
+
+import pydantic
+
+from concourseatom.timing import format_table, tree_order
+
+
+def live_models() -> Counter:
+    """Number of live model instances by class name"""
+    return Counter(
+        type(obj).__name__
+        for obj in gc.get_objects()
+        if isinstance(obj, pydantic.BaseModel)
+    )
+
+
+class _PhaseMemory:
+    __slots__ = ("calls", "peak_bytes", "retained_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.peak_bytes = 0
+        self.retained_bytes = 0
+
+
+class MemoryTracker:
+    """Hook recording the peak memory allocated within each phase
+
+    The peak of a phase is the most memory allocated above what was allocated when
+    it started, and retained is what was still allocated when it ended. Both are the
+    largest over every call of the phase. Phases are keyed by their path of nested
+    phase names like :class:`concourseatom.timing.PhaseTimer`. Live models are
+    counted when each phase in count_after ends.
+
+    :param count_after: Names of the phases to count live models after
+    """
+
+    def __init__(self, count_after: Tuple[str, ...] = ("merge",)):
+        self.stats: Dict[Tuple[str, ...], _PhaseMemory] = {}
+        self.models: Dict[str, Counter] = {}
+        self.count_after = count_after
+        self._path: Tuple[str, ...] = ()
+        # Allocated at the start and highest peak so far of each open phase
+        self._open: List[List[int]] = []
+
+    def _update_peaks(self) -> int:
+        """Fold the peak since the last check into every open phase"""
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in self._open:
+            frame[1] = max(frame[1], peak)
+        tracemalloc.reset_peak()
+        return current
+
+    @contextmanager
+    def __call__(self, name: str, args: Dict[str, Any]):
+        parent = self._path
+        self._path = path = parent + (name,)
+        current = self._update_peaks()
+        frame = [current, current]
+        self._open.append(frame)
+        try:
+            yield
+        finally:
+            end = self._update_peaks()
+            self._open.pop()
+            self._path = parent
+            stats = self.stats.get(path)
+            if stats is None:
+                stats = self.stats[path] = _PhaseMemory()
+            stats.calls += 1
+            stats.peak_bytes = max(stats.peak_bytes, frame[1] - frame[0])
+            stats.retained_bytes = max(stats.retained_bytes, end - frame[0])
+            if name in self.count_after:
+                self.models[name] = live_models()
+                # Counting is not part of any phase so leave it out of their peaks
+                tracemalloc.reset_peak()
+
+    def report(self) -> str:
+        """Tables of the peak memory of each phase and the live models counted"""
+        rows: List[Tuple[str, ...]] = [("phase", "calls", "peak KiB", "retained KiB")]
+        for path in tree_order(self.stats):
+            stats = self.stats[path]
+            rows.append(
+                (
+                    "  " * (len(path) - 1) + path[-1],
+                    str(stats.calls),
+                    f"{stats.peak_bytes / 1024:.1f}",
+                    f"{stats.retained_bytes / 1024:.1f}",
+                )
+            )
+        lines = format_table(rows, "<>>>")
+
+        for name, counts in self.models.items():
+            lines.append("")
+            lines.extend(
+                format_table(
+                    [(f"live models after {name}", "count")]
+                    + [(cls, str(count)) for cls, count in counts.most_common()]
+                    + [("total", str(sum(counts.values())))],
+                    "<>",
+                )
+            )
+        return "\n".join(lines)
@@ -4,13 +4,39 @@
 
 from __future__ import annotations
 from abc import ABC, abstractmethod  # This enables forward reference of types
-from typing import Any, Dict, Optional, List, Tuple, Union
-
-from pydantic import Field, root_validator
+from io import StringIO
+import json
+from typing import (
+    Any,
+    Container,
+    Dict,
+    Hashable,
+    Iterable,
+    Optional,
+    List,
+    Callable,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+from pydantic import (
+    BaseModel,
+    Field,
+    PrivateAttr,
+    ValidationError,
+    root_validator,
+    validator,
+)
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+from pydantic.types import StrBytes
 from pydantic_yaml import YamlModel
 
+from concourseatom.timing import phase
+
 
-def get_uniquename(name: str, namelist: List[str]) -> str:
+def get_uniquename(name: str, namelist: Container[str]) -> str:
     """get a unique name to add to the list based on its original name and
     incrementing the counter until we hit a unique entry"""
 
@@ -23,6 +49,179 @@ def get_uniquename(name: str, namelist: List[str]) -> str:
     return b_alt_name
 
 
+class NameRegistry:
+    """Set of names in use that allocates unique alternative names
+
+    Allocates the same names as repeated calls to :func:`get_uniquename` with every
+    allocated name added to the namelist, but remembers the next suffix to try for
+    each base name rather than probing from ``-000`` each time.
+    Names are never removed so the remembered suffixes stay valid.
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._names: Set[str] = set(names)
+        self._next_index: Dict[str, int] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names
+
+    def add(self, name: str) -> None:
+        self._names.add(name)
+
+    def allocate(self, name: str) -> str:
+        """Get a unique name based on name and register it as used"""
+        index_num = self._next_index.get(name, 0)
+        b_alt_name = f"{name}-{index_num:0>3}"
+        while b_alt_name in self._names:
+            index_num += 1
+            b_alt_name = f"{name}-{index_num:0>3}"
+
+        self._names.add(b_alt_name)
+        self._next_index[name] = index_num + 1
+        return b_alt_name
+
+
+def _freeze(value: Any) -> Hashable:
+    """Convert a nested structure of dicts and lists into a hashable equivalent.
+
+    Values that compare equal freeze to equal keys, so the result can be used to
+    bucket items before confirming equality with ``==``.
+    """
+    if isinstance(value, dict):
+        return frozenset((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    return value
+
+
+def _exact_content_key(value: Any) -> Hashable:
+    """Hashable key of every field of a nested structure of models, lists and dicts
+
+    Unlike :func:`_freeze` this keeps the order of lists and dicts and the types of
+    values such as ``True`` and ``1``, so equal keys give the same YAML or JSON. It
+    reads the fields of models directly rather than through ``dict()``, which costs
+    more than the rest of the walk.
+    """
+    cls = type(value)
+    if cls is str or value is None:
+        return value
+    if isinstance(value, BaseModel):
+        return (cls, *map(_exact_content_key, value.__dict__.values()))
+    if cls is list or cls is tuple:
+        return (list, *map(_exact_content_key, value))
+    if cls is dict:
+        items = value.items()
+        return (dict, *((key, _exact_content_key(item)) for key, item in items))
+    return (cls, value)
+
+
+class FingerprintModel(YamlModel):
+    """YamlModel with a cached fingerprint of its content
+
+    The fingerprint is the hash of :meth:`content_key` and is used as ``__hash__`` by
+    models that override ``__eq__``. Objects that are equal have equal fingerprints so
+    a mismatch proves two objects differ. Fields that ``__eq__`` ignores (eg name) are
+    left out of the key. Models containing steps build their key from the
+    fingerprints of those steps so a plan is hashed bottom up, each node once.
+
+    The fingerprint is cached on first use. Assigning a field or copying with changes
+    clears the cache but mutating nested lists or dicts in place does not, so objects
+    should not be mutated in place once they have been hashed.
+    """
+
+    _fingerprint: Optional[int] = PrivateAttr(default=None)
+
+    class Config:
+        # Steps are dispatched to their model before validation so accept an
+        # instance of any member of a Union as is rather than trying each in turn
+        smart_union = True
+
+    def content_key(self) -> Hashable:
+        """Hashable key of the content of the object consistent with ``__eq__``"""
+        return _freeze(self.dict())
+
+    def fingerprint(self) -> int:
+        if self._fingerprint is None:
+            self._fingerprint = hash(self.content_key())
+        return self._fingerprint
+
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
+    def _clear_caches(self) -> None:
+        """Drop values derived from the content of the object"""
+        self._fingerprint = None
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name not in self.__private_attributes__:
+            self._clear_caches()
+
+    def __setstate__(self, state):
+        # str hashes differ between interpreters so never trust a pickled fingerprint
+        super().__setstate__(state)
+        self._clear_caches()
+
+    def copy(self, **kwargs) -> FingerprintModel:
+        copied = super().copy(**kwargs)
+        if kwargs.get("update") or kwargs.get("include") or kwargs.get("exclude"):
+            copied._clear_caches()
+        return copied
+
+
+def _optional_eq(left: Any, right: Any) -> bool:
+    """Compare values that may be None
+
+    Models with their own ``__eq__`` expect to be compared with their own kind so
+    None is only equal to None.
+    """
+    if left is None or right is None:
+        return left is right
+    return left == right
+
+
+def _unordered_eq(left: List[FingerprintModel], right: List[FingerprintModel]) -> bool:
+    """Order insensitive comparison of two lists of models
+
+    Items are paired by fingerprint so only items whose fingerprints collide are
+    compared structurally.
+    """
+    if len(left) != len(right):
+        return False
+
+    candidates: Dict[int, List[FingerprintModel]] = {}
+    for item in left:
+        candidates.setdefault(item.fingerprint(), []).append(item)
+
+    for item in right:
+        bucket = candidates.get(item.fingerprint(), [])
+        match = next((index for index, obj in enumerate(bucket) if obj == item), None)
+        if match is None:
+            return False
+        del bucket[match]
+
+    return True
+
+
+def _rewrite_list(items: List[Any], rewrite: Callable[[Any], Any]) -> List[Any]:
+    """Apply rewrite to every item returning items itself if no item was changed
+
+    Rewrites return their input when they have nothing to change, so an unchanged
+    list can be shared rather than rebuilt.
+    """
+    rewritten = [rewrite(item) for item in items]
+    if all(new is old for new, old in zip(rewritten, items)):
+        return items
+    return rewritten
+
+
+def _is_identity(rewrites: Dict[str, str]) -> bool:
+    """Check if a rewrite map leaves every name unchanged"""
+    return all(name == rewrite for name, rewrite in rewrites.items())
+
+
 def get_random_ingredients(kind=None):
     """
     >>> 1+1
@@ -57,6 +256,10 @@ class StepABC(ABC):
         # return self.copy(deep=True)
 
     @abstractmethod
+    def accept(self, visitor: StepVisitor) -> StepABC:
+        """Dispatch to the method of visitor for this type of step"""
+        pass
+
     def handles(self) -> List[Tuple[str, str]]:
         """
         Recursively get the handles used by the job AND their resource if there
@@ -65,7 +268,15 @@ class StepABC(ABC):
         Returns:
             List[Tuple[str, str]]: List of handle, resource
         """
-        pass
+        visitor = RewriteVisitor(collect_handles=True)
+        self.accept(visitor)
+        return visitor.handles
+
+    def resource_rewrite(self, resource_rewrites: Dict[str, str]) -> StepABC:
+        return self.accept(RewriteVisitor(resource_rewrites=resource_rewrites))
+
+    def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> StepABC:
+        return self.accept(RewriteVisitor(handle_rewrites=handle_rewrites))
 
     @abstractmethod
     def sort_key(self) -> str:
@@ -73,7 +284,74 @@ class StepABC(ABC):
         pass
 
 
+class _UniquesIndex:
+    """Ordered collection of the output of :meth:`RewritesABC.uniques_and_rewrites`
+
+    Items are held in insertion order and indexed both by
+    :meth:`FingerprintModel.fingerprint` and by name so that lookups of an equal item
+    or of an item with the same name do not need to scan the whole collection.
+    Lookups return the earliest matching item, as a scan of the list would.
+    The index can be kept and extended across several merges.
+    """
+
+    def __init__(self, items: Iterable[RewritesABC]):
+        self._next_seq = 0
+        self._items: Dict[int, RewritesABC] = {}
+        self._by_key: Dict[int, List[int]] = {}
+        self._by_name: Dict[str, List[int]] = {}
+        self.names = NameRegistry()
+        for item in items:
+            self.append(item)
+
+    def append(self, item: RewritesABC) -> None:
+        seq = self._next_seq
+        self._next_seq += 1
+        self._items[seq] = item
+        self._by_key.setdefault(item.fingerprint(), []).append(seq)
+        self._by_name.setdefault(item.name, []).append(seq)
+        self.names.add(item.name)
+
+    def find_equal(self, item: RewritesABC) -> Optional[RewritesABC]:
+        """First item which is equal (ignoring name) to item"""
+        for seq in self._by_key.get(item.fingerprint(), []):
+            if self._items[seq] == item:
+                return self._items[seq]
+        return None
+
+    def find_named(self, name: str) -> Optional[RewritesABC]:
+        """First item with the given name"""
+        seqs = self._by_name.get(name)
+        return self._items[seqs[0]] if seqs else None
+
+    def remove(self, item: RewritesABC) -> None:
+        """Remove the first item that is, or is equal to, item"""
+        key = item.fingerprint()
+        seqs = self._by_key[key]
+        seq = next(
+            seq for seq in seqs if self._items[seq] is item or self._items[seq] == item
+        )
+        removed = self._items.pop(seq)
+
+        seqs.remove(seq)
+        if not seqs:
+            del self._by_key[key]
+
+        name_seqs = self._by_name[removed.name]
+        name_seqs.remove(seq)
+        if not name_seqs:
+            del self._by_name[removed.name]
+
+    def to_list(self) -> List[RewritesABC]:
+        return list(self._items.values())
+
+
 class RewritesABC(ABC):
+    """ABC for objects that can have resource and handle names rewritten
+
+    Rewrites never modify the object. They return the object itself when there is
+    nothing to change and otherwise a copy that shares any unchanged parts.
+    """
+
     @abstractmethod
     def resource_rewrite(self, resource_rewrites: Dict[str, str]) -> StepABC:
         pass
@@ -98,106 +376,121 @@ class RewritesABC(ABC):
 
         return the final list AND a dict of resource_rewrites and handle_rewrites
         """
+        ret_index = _UniquesIndex(aList)
+        resource_rewrite_map = cls._add_uniques(ret_index, bList, deep)
+        return ret_index.to_list(), resource_rewrite_map
+
+    @classmethod
+    def _add_uniques(
+        cls, ret_index: _UniquesIndex, bList: List[RewritesABC], deep: bool = False
+    ) -> Dict[str, str]:
+        """Add bList to the uniques already in ret_index following the rules of
+        :meth:`uniques_and_rewrites` and return the rewrites for bList"""
+        with phase(f"uniques_and_rewrites:{cls.__name__}", items=len(bList)):
+            names = ret_index.names
+            resource_rewrite_map: Dict[str, str] = {}
+
+            for item in bList:
+                existing_item = ret_index.find_equal(item)
+                if existing_item is not None:  # Item already exists so map it
+                    resource_rewrite_map[item.name] = existing_item.name
+                elif (
+                    item.name in names
+                ):  # Name already used for different item so rename it and then add
+                    # If using deep mode then work out the recursive deep merge
+
+                    if deep:
+                        # Note deep is only valid for Job (not Resource or
+                        # Resource_type)
+
+                        # get the item we plan to deep merge in
+                        target_item = ret_index.find_named(item.name)
+
+                        with phase("deep_merge:handles", job=item.name):
+                            handle_rewrites = cls._deep_merge_handle_rewrites(
+                                target_item, item
+                            )
 
-        ret_list: List[RewritesABC] = aList.copy()
-        resource_rewrite_map: Dict[str, str] = {}
+                        new_item = item.handle_rewrite(handle_rewrites)
+                        with phase("deep_merge", job=item.name):
+                            new_target = target_item.deep_merge(new_item)
 
-        for item in bList:
-            if item in ret_list:  # Item already exists so map it
-                resource_rewrite_map[item.name] = next(
-                    obj.name for obj in ret_list if obj == item
-                )
-            elif any(
-                resource.name == item.name for resource in ret_list
-            ):  # Name already used for different item so rename it and then add
-                # If using deep mode then work out the recursive deep merge
+                        # Replace the target item with the deep_merged update
+                        ret_index.remove(target_item)
+                        ret_index.append(new_target)
 
-                if deep:
-                    # Note deep is only valid for Job (not Resource or Resource_type)
+                        resource_rewrite_map[item.name] = target_item.name
+                        # print(new_target)
+                        # Do not update ret_list via append as items are
+                        # deep_merged in
+                    else:
 
-                    # get the item we plan to deep merge in
-                    target_item = next(
-                        resource for resource in ret_list if resource.name == item.name
-                    )
+                        # Names of all output objects are tracked by the registry
+                        alt_name = names.allocate(item.name)
 
-                    target_handles = target_item.handles()
-                    all_handles = item.handles()
-
-                    # parse handles selecting those that are not None first (ie real
-                    # resources)
-                    handles = [
-                        (handle, resource)
-                        for handle, resource in all_handles
-                        if resource is not None
-                    ]
-                    # Find those that are not resources or we have not been used in
-                    # resources
-                    none_handles = [
-                        handle for handle, resource in all_handles if resource is None
-                    ]
-                    # Find those never associatd to a resource
-                    missing_handles = list(
-                        set(none_handles) - set(handle for handle, resource in handles)
-                    )
-                    # Final set is resources AND those never associated to a resource
-                    handles.extend((handle, None) for handle in missing_handles)
-
-                    # ToDo: dedup here
-
-                    handle_rewrites: Dict[str, str] = {}
-                    handle_list = target_handles.copy()
-
-                    for handle in handles:
-                        if handle in handle_list:
-                            # if handle in target and same resource then rewrite to same
-                            # name NOT add to list
-                            handle_rewrites[handle[0]] = handle[0]
-                        elif handle[0] in (
-                            target_handle
-                            for target_handle, target_resource in handle_list
-                        ):
-                            # if handle in target BUT different resource then create
-                            # rewrite of handle
-                            alt_name = get_uniquename(
-                                handle[0],
-                                (
-                                    target_handle
-                                    for target_handle, target_resource in handle_list
-                                ),
-                            )
-                            handle_rewrites[handle[0]] = alt_name
-                            handle_list.append((alt_name, handle[1]))
-                        else:
-                            # else add entry and rewrite to itself
-                            handle_rewrites[handle[0]] = handle[0]
-                            handle_list.append(handle)
+                        # Update the new name with the proposed rewrite name
+                        resource_rewrite_map[item.name] = alt_name
 
-                    new_item = item.handle_rewrite(handle_rewrites)
-                    new_target = target_item.deep_merge(new_item)
+                        ret_index.append(item.copy(update={"name": alt_name}))
+                else:  # Item is unique so add it
+                    resource_rewrite_map[item.name] = item.name
+                    ret_index.append(item)
 
-                    # Replace the target item with the deep_merged update
-                    ret_list.remove(target_item)
-                    ret_list.append(new_target)
+        return resource_rewrite_map
 
-                    resource_rewrite_map[item.name] = target_item.name
-                    # print(new_target)
-                    # Do not update ret_list via append as items are deep_merged in
-                else:
+    @staticmethod
+    def _deep_merge_handle_rewrites(
+        target_item: RewritesABC, item: RewritesABC
+    ) -> Dict[str, str]:
+        """Rewrites of the handles of item to deep merge it into target_item
 
-                    # Get the list of all names in output objects
-                    namelist = [resource.name for resource in ret_list]
+        Handles of item that are in target_item for the same resource keep their
+        name and those used in target_item for a different resource are renamed.
+        """
+        target_handles = target_item.handles()
+        all_handles = item.handles()
+
+        # parse handles selecting those that are not None first (ie real resources)
+        handles = [
+            (handle, resource)
+            for handle, resource in all_handles
+            if resource is not None
+        ]
+        # Find those that are not resources or we have not been used in resources
+        none_handles = [handle for handle, resource in all_handles if resource is None]
+        # Find those never associatd to a resource
+        missing_handles = list(
+            set(none_handles) - set(handle for handle, resource in handles)
+        )
+        # Final set is resources AND those never associated to a resource
+        handles.extend((handle, None) for handle in missing_handles)
 
-                    alt_name = get_uniquename(item.name, namelist)
+        # ToDo: dedup here
 
-                    # Update the new name with the proposed rewrite name
-                    resource_rewrite_map[item.name] = alt_name
+        handle_rewrites: Dict[str, str] = {}
+        handle_set = set(target_handles)
+        handle_names = NameRegistry(
+            target_handle for target_handle, target_resource in handle_set
+        )
 
-                    ret_list.append(item.copy(deep=True, update={"name": alt_name}))
-            else:  # Item is unique so add it
-                resource_rewrite_map[item.name] = item.name
-                ret_list.append(item.copy(deep=True))
+        for handle in handles:
+            if handle in handle_set:
+                # if handle in target and same resource then rewrite to same name NOT
+                # add to list
+                handle_rewrites[handle[0]] = handle[0]
+            elif handle[0] in handle_names:
+                # if handle in target BUT different resource then create rewrite of
+                # handle
+                alt_name = handle_names.allocate(handle[0])
+                handle_rewrites[handle[0]] = alt_name
+                handle_set.add((alt_name, handle[1]))
+            else:
+                # else add entry and rewrite to itself
+                handle_rewrites[handle[0]] = handle[0]
+                handle_set.add(handle)
+                handle_names.add(handle[0])
 
-        return ret_list, resource_rewrite_map
+        return handle_rewrites
 
     @classmethod
     def rewrites(
@@ -209,7 +502,7 @@ class RewritesABC(ABC):
         return [resource.resource_rewrite(resource_rewrites) for resource in in_list]
 
 
-class ResourceType(YamlModel, RewritesABC):
+class ResourceType(FingerprintModel, RewritesABC):
     name: str
     type: str
     source: Dict[str, Any] = Field(default_factory=dict)
@@ -220,6 +513,8 @@ class ResourceType(YamlModel, RewritesABC):
     defaults: Dict[str, Any] = Field(default_factory=dict)
 
     def __eq__(self, other: ResourceType) -> bool:
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             self.type == other.type
             and self.source == other.source
@@ -230,20 +525,38 @@ class ResourceType(YamlModel, RewritesABC):
             and self.defaults == other.defaults
         )
 
+    def content_key(self) -> Hashable:
+        return (
+            self.type,
+            _freeze(self.source),
+            self.privileged,
+            _freeze(self.params),
+            self.check_every,
+            _freeze(self.tags),
+            _freeze(self.defaults),
+        )
+
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
     def resource_rewrite(
         self,
         resource_rewrites: Dict[str, str],
     ) -> ResourceType:
-        return self.copy(deep=True, update={"type": resource_rewrites[self.type]})
+        if resource_rewrites[self.type] == self.type:
+            return self
+        return self.copy(update={"type": resource_rewrites[self.type]})
 
     def __lt__(self, other):
         return self.name < other.name
 
     def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> ResourceType:
-        return self.copy(deep=True, update={"name": handle_rewrites[self.name]})
+        if handle_rewrites[self.name] == self.name:
+            return self
+        return self.copy(update={"name": handle_rewrites[self.name]})
 
 
-class ResourceUnnamed(YamlModel):
+class ResourceUnnamed(FingerprintModel):
     """
     Class used by Resource and Task
     """
@@ -261,6 +574,8 @@ class ResourceUnnamed(YamlModel):
     webhook_token: Optional[str] = None
 
     def __eq__(self, other: Resource) -> bool:
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             self.type == other.type
             and self.source == other.source
@@ -275,6 +590,24 @@ class ResourceUnnamed(YamlModel):
             and self.webhook_token == other.webhook_token
         )
 
+    def content_key(self) -> Hashable:
+        return (
+            self.type,
+            _freeze(self.source),
+            self.old_name,
+            self.icon,
+            self.version,
+            self.check_every,
+            self.check_timeout,
+            self.expose_build_created_by,
+            _freeze(self.tags),
+            self.public,
+            self.webhook_token,
+        )
+
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
     def __lt__(self, other):
         return self.type < other.type
 
@@ -288,13 +621,17 @@ class Resource(ResourceUnnamed, RewritesABC):
         self,
         resource_rewrites: Dict[str, str],
     ) -> ResourceUnnamed:
-        return self.copy(deep=True, update={"type": resource_rewrites[self.type]})
+        if resource_rewrites[self.type] == self.type:
+            return self
+        return self.copy(update={"type": resource_rewrites[self.type]})
 
     def __lt__(self, other):
         return self.name < other.name
 
     def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> ResourceUnnamed:
-        return self.copy(deep=True, update={"name": handle_rewrites[self.name]})
+        if handle_rewrites[self.name] == self.name:
+            return self
+        return self.copy(update={"name": handle_rewrites[self.name]})
 
 
 class Command(YamlModel):
@@ -358,7 +695,7 @@ class TaskConfig(YamlModel):
         return next(output for output in self.outputs if output.name == name)
 
 
-class Task(YamlModel, StepABC, RewritesABC):
+class Task(FingerprintModel, StepABC, RewritesABC):
     """Concourse Task class
 
     :param task: Name of the task
@@ -382,6 +719,8 @@ class Task(YamlModel, StepABC, RewritesABC):
         return self.output_mapping[name] if name in self.output_mapping else name
 
     def __eq__(self, other: Task) -> bool:
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             self.task == other.task
             and self.config == other.config
@@ -417,61 +756,40 @@ class Task(YamlModel, StepABC, RewritesABC):
             )
         )
 
-    def sort_key(self) -> str:
-        return f"Task:{self.task}"
-
-    def resource_rewrite(
-        self,
-        resource_rewrites: Dict[str, str],
-    ) -> Task:
-        # ToDo: Why do we need these checks
-        if self.file:
-            raise Exception(f"No support for file in {self}")
-
-        return self.copy(
-            deep=True,
-        )
-
-    def handle_rewrite(
-        self,
-        handle_rewrites: Dict[str, str],
-    ) -> Task:
-        if not self.config:
-            raise Exception(f"Task needs config for {self}")
+    def __hash__(self) -> int:
+        return self.fingerprint()
 
-        return self.copy(
-            deep=True,
-            update={
-                "input_mapping": {
-                    input.name: handle_rewrites[input.name]
-                    for input in self.config.inputs
-                },
-                "output_mapping": {
-                    output.name: handle_rewrites[output.name]
-                    for output in self.config.outputs
-                },
-            },
+    def content_key(self) -> Hashable:
+        return (
+            self.task,
+            _freeze(self.config.dict()) if self.config else None,
+            self.image,
+            _freeze(self.vars),
+            _freeze(self.container_limits.dict()) if self.container_limits else None,
+            _freeze(self.params),
+            frozenset(self._effective_input(input.name) for input in self.config.inputs)
+            if self.config
+            else None,
+            frozenset(
+                self._effective_output(output.name) for output in self.config.outputs
+            )
+            if self.config
+            else None,
         )
 
-    def handles(self) -> List[Tuple[str, str]]:
-        retval: List[Tuple[str, str]] = []
-
-        for handle in self.config.inputs:
-            retval.append((handle.name, None))
-        for handle in self.config.outputs:
-            retval.append((handle.name, None))
-
-        # ToDo: Consider input_mapping and output_mapping also
+    def accept(self, visitor: StepVisitor) -> Task:
+        return visitor.visit_task(self)
 
-        return retval
+    def sort_key(self) -> str:
+        return f"Task:{self.task}"
 
     def deep_merge(self, other: Task) -> Task:
         if self != other:
             raise Exception(f"deep_merge Task MUST be identical: {self} != {other}")
-        return self.copy(deep=True)
+        return self
 
 
-class Get(YamlModel, StepABC, RewritesABC):
+class Get(FingerprintModel, StepABC, RewritesABC):
     get: str
     resource: Optional[str] = None
     passed: List[str] = Field(default_factory=list)
@@ -480,6 +798,8 @@ class Get(YamlModel, StepABC, RewritesABC):
     version: str = "latest"
 
     def __eq__(self, other: Get) -> bool:
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             self.get == other.get
             and (self.effective_resource() == other.effective_resource())
@@ -489,6 +809,22 @@ class Get(YamlModel, StepABC, RewritesABC):
             and self.version == other.version
         )
 
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
+    def content_key(self) -> Hashable:
+        return (
+            self.get,
+            self.effective_resource(),
+            _freeze(self.passed),
+            _freeze(self.params),
+            self.trigger,
+            self.version,
+        )
+
+    def accept(self, visitor: StepVisitor) -> Get:
+        return visitor.visit_get(self)
+
     def sort_key(self) -> str:
         return f"Get:{self.get}"
 
@@ -499,27 +835,13 @@ class Get(YamlModel, StepABC, RewritesABC):
         if not self.resource:
             self.resource = self.get
 
-    def resource_rewrite(
-        self,
-        resource_rewrites: Dict[str, str],
-    ) -> Get:
-        return self.copy(
-            deep=True, update={"resource": resource_rewrites[self.effective_resource()]}
-        )
-
-    def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> Get:
-        return self.copy(deep=True, update={"get": handle_rewrites[self.get]})
-
     def deep_merge(self, other: Get) -> Get:
         if self != other:
             raise Exception(f"deep_merge Get MUST be identical: {self} != {other}")
-        return self.copy(deep=True)
-
-    def handles(self) -> List[Tuple[str, str]]:
-        return [(self.get, self.resource if self.resource else self.get)]
+        return self
 
 
-class Put(YamlModel, StepABC, RewritesABC):
+class Put(FingerprintModel, StepABC, RewritesABC):
     put: str
     resource: Optional[str] = None
     inputs: str = "all"
@@ -527,6 +849,8 @@ class Put(YamlModel, StepABC, RewritesABC):
     get_params: Optional[Any] = None
 
     def __eq__(self, other: Put) -> bool:
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             self.put == other.put
             and (self.effective_resource() == other.effective_resource())
@@ -535,6 +859,21 @@ class Put(YamlModel, StepABC, RewritesABC):
             and self.get_params == other.get_params
         )
 
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
+    def content_key(self) -> Hashable:
+        return (
+            self.put,
+            self.effective_resource(),
+            self.inputs,
+            _freeze(self.params),
+            _freeze(self.get_params),
+        )
+
+    def accept(self, visitor: StepVisitor) -> Put:
+        return visitor.visit_put(self)
+
     def sort_key(self) -> str:
         return f"Put:{self.put}"
 
@@ -545,79 +884,71 @@ class Put(YamlModel, StepABC, RewritesABC):
     def effective_resource(self):
         return self.resource if self.resource else self.put
 
-    def resource_rewrite(
-        self,
-        resource_rewrites: Dict[str, str],
-    ) -> Put:
-        return self.copy(
-            deep=True, update={"resource": resource_rewrites[self.effective_resource()]}
-        )
-
-    def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> Put:
-        return self.copy(deep=True, update={"put": handle_rewrites[self.put]})
-
     def deep_merge(self, other: Put) -> Put:
         if self != other:
             raise Exception(f"deep_merge Put MUST be identical: {self} != {other}")
-        return self.copy(deep=True)
-
-    def handles(self) -> List[Tuple[str, str]]:
-        return [(self.put, self.resource if self.resource else self.put)]
+        return self
 
 
-class Do(YamlModel, StepABC, RewritesABC):
+class Do(FingerprintModel, StepABC, RewritesABC):
     do: List[Step]
 
+    @validator("do", pre=True)
+    def dispatch_steps(cls, value):
+        return _parse_steps(value)
+
+    def __eq__(self, other: Do) -> bool:
+        if self is other:
+            return True
+        if self.fingerprint() != other.fingerprint():
+            return False
+        return self.do == other.do
+
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
+    def content_key(self) -> Hashable:
+        return tuple(step.fingerprint() for step in self.do)
+
+    def accept(self, visitor: StepVisitor) -> Do:
+        return visitor.visit_do(self)
+
     def sort_key(self) -> str:
         return f"Do:{self.do}"
 
-    def resource_rewrite(
-        self,
-        resource_rewrites: Dict[str, str],
-    ) -> Do:
-        return self.copy(
-            deep=True,
-            update={
-                "do": [step.resource_rewrite(resource_rewrites) for step in self.do]
-            },
-        )
-
     def deep_merge(self, other: Do) -> Do:
         if len(self.do) != len(other.do):
             raise Exception(f"deep_merge Do MUST be same lengths: {self} != {other}")
-        return self.copy(
-            deep=True,
-            update={
-                "do": [
-                    self_do.deep_merge(other_do)
-                    for self_do, other_do in zip(self.do, other.do)
-                ]
-            },
-        )
+        do = [
+            self_do.deep_merge(other_do) for self_do, other_do in zip(self.do, other.do)
+        ]
+        if all(new is old for new, old in zip(do, self.do)):
+            return self
+        return self.copy(update={"do": do})
 
-    def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> Do:
-        return self.copy(
-            deep=True,
-            update={"do": [step.handle_rewrite(handle_rewrites) for step in self.do]},
-        )
 
-    def handles(self) -> List[Tuple[str, str]]:
-
-        return [handle for step in self.do for handle in step.handles()]
-
-
-class In_parallel(YamlModel, StepABC, RewritesABC):
+class In_parallel(FingerprintModel, StepABC, RewritesABC):
     class Config(YamlModel):
         steps: List[Step]
         limit: Optional[int] = None
         fail_fast: bool = False
 
+        class Config:
+            smart_union = True
+
+        @validator("steps", pre=True)
+        def dispatch_steps(cls, value):
+            return _parse_steps(value)
+
     # in_parallel: Union[List[Step], In_parallel.Config]
     # Above Union should work but there seems to be a bug in Pydantic where it cannot
     # recognise/check all lists. Maybe need to consider to use pre rather than post
     # substitution
     in_parallel: In_parallel.Config
 
+    def accept(self, visitor: StepVisitor) -> In_parallel:
+        return visitor.visit_in_parallel(self)
+
     def sort_key(self) -> str:
         """Sort key for all Step objects"""
         return f'In_parallel:{"".join(step.sort_key() for step in sorted(self.in_parallel.steps, key=StepABC.sort_key))}'  # noqa: E501
@@ -628,11 +959,25 @@ class In_parallel(YamlModel, StepABC, RewritesABC):
         return item.sort_key()
 
     def __eq__(self, other: In_parallel) -> bool:
+        if self is other:
+            return True
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             self.in_parallel.limit == other.in_parallel.limit
             and self.in_parallel.fail_fast == other.in_parallel.fail_fast
-            and sorted(self.in_parallel.steps, key=In_parallel.step_sortkey)
-            == sorted(other.in_parallel.steps, key=In_parallel.step_sortkey)
+            and _unordered_eq(self.in_parallel.steps, other.in_parallel.steps)
+        )
+
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
+    def content_key(self) -> Hashable:
+        # Order of steps is not significant so use the sorted step fingerprints
+        return (
+            self.in_parallel.limit,
+            self.in_parallel.fail_fast,
+            tuple(sorted(step.fingerprint() for step in self.in_parallel.steps)),
         )
 
     @root_validator(pre=True)
@@ -642,64 +987,342 @@ class In_parallel(YamlModel, StepABC, RewritesABC):
             values["in_parallel"] = {"steps": values.get("in_parallel")}
         return values
 
-    def resource_rewrite(
-        self,
-        resource_rewrites: Dict[str, str],
-    ) -> In_parallel:
-        return self.copy(
-            deep=True,
-            update={
-                "in_parallel": self.in_parallel.copy(
-                    deep=True,
-                    update={
-                        "steps": [
-                            step.resource_rewrite(resource_rewrites)
-                            for step in self.in_parallel.steps
-                        ]
-                    },
-                ),
-            },
-        )
-
-    def handle_rewrite(self, handle_rewrites: Dict[str, str]) -> In_parallel:
+    def _with_steps(self, steps: List[Step]) -> In_parallel:
+        """Copy with the steps replaced, or self if they are unchanged"""
+        if steps is self.in_parallel.steps:
+            return self
         return self.copy(
-            deep=True,
-            update={
-                "in_parallel": self.in_parallel.copy(
-                    deep=True,
-                    update={
-                        "steps": [
-                            step.handle_rewrite(handle_rewrites)
-                            for step in self.in_parallel.steps
-                        ]
-                    },
-                ),
-            },
+            update={"in_parallel": self.in_parallel.copy(update={"steps": steps})}
         )
 
-    def handles(self) -> List[Tuple[str, str]]:
-        return [handle for step in self.in_parallel.steps for handle in step.handles()]
-
     def deep_merge(self, other: In_parallel) -> In_parallel:
         # For every item in the add it if it does not already exist
-        new_parallel = self.copy(deep=True)
+        steps = self.in_parallel.steps
+        steps_by_fingerprint: Dict[int, List[Step]] = {}
+        for step in steps:
+            steps_by_fingerprint.setdefault(step.fingerprint(), []).append(step)
 
         for step in other.in_parallel.steps:
-            if step in new_parallel.in_parallel.steps:
-                print(f"Already have {step}")
-            else:
-                new_parallel.in_parallel.steps.append(step.copy(deep=True))
+            # Steps already present are skipped
+            if step not in steps_by_fingerprint.get(step.fingerprint(), []):
+                if steps is self.in_parallel.steps:
+                    steps = steps.copy()
+                steps.append(step)
+                steps_by_fingerprint.setdefault(step.fingerprint(), []).append(step)
 
-        return new_parallel
+        return self._with_steps(steps)
 
 
 Step = Union[Get, Put, Task, In_parallel, Do]
 
+# Every type of step is identified by a key unique to it
+_step_classes = {
+    "get": Get,
+    "put": Put,
+    "task": Task,
+    "in_parallel": In_parallel,
+    "do": Do,
+}
+
+
+def _parse_step(value: Any) -> Any:
+    """Parse a raw step into the model identified by its key
+
+    This validates each step against exactly one model rather than letting the
+    :data:`Step` Union try each model in turn. Anything that is not a valid step is
+    left for the Union to validate and report with the location of the error.
+    """
+    if isinstance(value, dict):
+        for key, step_class in _step_classes.items():
+            if key in value:
+                try:
+                    return step_class.parse_obj(value)
+                except ValidationError:
+                    return value
+    return value
+
+
+def _parse_steps(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_parse_step(step) for step in value]
+    return value
+
+
+def _construct_value(type_: Any, value: Any) -> Any:
+    """Build a value of type_ from trusted raw data without validating it"""
+    if isinstance(value, dict):
+        if getattr(type_, "__origin__", None) is Union:
+            # Step, possibly Optional, is picked by its unique key as in _parse_step
+            type_ = next(
+                (
+                    cls
+                    for key, cls in _step_classes.items()
+                    if key in value and cls in type_.__args__
+                ),
+                None,
+            )
+        if isinstance(type_, type) and issubclass(type_, BaseModel):
+            return _construct_model(type_, value)
+    return value
+
+
+def _construct_field(field: ModelField, value: Any) -> Any:
+    if field.shape == SHAPE_SINGLETON:
+        return _construct_value(field.type_, value)
+    if field.shape == SHAPE_LIST and isinstance(value, list):
+        return [_construct_value(field.type_, item) for item in value]
+    return value
+
+
+def _construct_model(cls: type, values: Dict[str, Any]) -> BaseModel:
+    """Recursively build a model from trusted raw data without validating it
+
+    Pre root validators are still applied as they reshape the raw data (eg the
+    compact list style of ``in_parallel``). Values are used as they are so they must
+    already be of the right types, as in the output of a previous run.
+    """
+    for pre_root_validator in cls.__pre_root_validators__:
+        values = pre_root_validator(cls, values)
+
+    fields = {
+        name: _construct_field(field, values[field.alias])
+        for name, field in cls.__fields__.items()
+        if field.alias in values
+    }
+    return cls.construct(**fields)
+
+
+def _compact_value(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return _compact_dict(value)
+    if isinstance(value, list):
+        return [_compact_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _compact_value(item) for key, item in value.items()}
+    return value
+
+
+def _is_default(field: ModelField, value: Any) -> bool:
+    return _optional_eq(value, field.get_default())
+
+
+def _compact_dict(model: BaseModel) -> Dict[str, Any]:
+    """Like ``model.dict()`` but leaving out fields that hold their default
+
+    ``exclude_defaults`` of pydantic compares against ``field.default``, which is
+    None for fields with a ``default_factory``, so empty lists and dicts would be
+    kept. Parsing the result fills the left out fields back in with their defaults.
+    """
+    return {
+        field.alias: _compact_value(value)
+        for name, field in model.__fields__.items()
+        for value in (getattr(model, name),)
+        if field.required or not _is_default(field, value)
+    }
+
+
+def _json_document(b: StrBytes) -> Optional[Any]:
+    """The document b holds if it is JSON, otherwise None
+
+    JSON is a subset of YAML but the pure Python YAML loader is many times slower
+    than the JSON parser, so documents that look like a JSON object are tried as
+    JSON first. A YAML flow mapping that is not valid JSON also starts with ``{``
+    so a failure gives None rather than an error.
+    """
+    start = b.lstrip()[:1]
+    if start not in ("{", b"{"):
+        return None
+    try:
+        return json.loads(b)
+    except ValueError:
+        return None
+
+
 Do.update_forward_refs()
 In_parallel.update_forward_refs()
 In_parallel.Config.update_forward_refs()
 
 
+# Job fields holding a single step run on completion of the plan
+_job_hooks = ["on_success", "on_failure", "on_error", "on_abort", "ensure"]
+
+
+class StepVisitor:
+    """Transform of a tree of :data:`Step` objects
+
+    :meth:`visit` dispatches on the type of step to ``visit_<type>``. Leaf steps are
+    returned unchanged by default. ``Do`` and ``In_parallel`` visit their children and
+    are only copied if a child changed, so subclasses override the leaves they need
+    and get structural sharing for free. :meth:`visit_job` applies the visitor to the
+    plan and the ``on_success``/``on_failure``/``on_error``/``on_abort``/``ensure``
+    hooks of a :class:`Job`.
+    """
+
+    def visit(self, step: Step) -> Step:
+        return step.accept(self)
+
+    def visit_get(self, step: Get) -> Get:
+        return step
+
+    def visit_put(self, step: Put) -> Put:
+        return step
+
+    def visit_task(self, step: Task) -> Task:
+        return step
+
+    def visit_do(self, step: Do) -> Do:
+        do = _rewrite_list(step.do, self.visit)
+        if do is step.do:
+            return step
+        return step.copy(update={"do": do})
+
+    def visit_in_parallel(self, step: In_parallel) -> In_parallel:
+        return step._with_steps(_rewrite_list(step.in_parallel.steps, self.visit))
+
+    def visit_plan(self, plan: List[Step]) -> List[Step]:
+        return _rewrite_list(plan, self.visit)
+
+    def visit_hook(self, step: Step) -> Step:
+        return self.visit(step)
+
+    def visit_job(self, job: Job) -> Job:
+        update: Dict[str, Any] = {}
+
+        plan = self.visit_plan(job.plan)
+        if plan is not job.plan:
+            update["plan"] = plan
+
+        for hook in _job_hooks:
+            step = getattr(job, hook)
+            if step:
+                new_step = self.visit_hook(step)
+                if new_step is not step:
+                    update[hook] = new_step
+
+        if not update:
+            return job
+        return job.copy(update=update)
+
+
+class RewriteVisitor(StepVisitor):
+    """Apply resource and handle rewrites and collect handles in one traversal
+
+    :param resource_rewrites: Map of resource names for Get and Put, if any
+    :param handle_rewrites: Map of handle names for Get, Put and Task, if any
+    :param collect_handles: Record the (handle, resource) pairs of the rewritten plan
+        in :attr:`handles`. Job hooks are not included.
+    """
+
+    def __init__(
+        self,
+        resource_rewrites: Optional[Dict[str, str]] = None,
+        handle_rewrites: Optional[Dict[str, str]] = None,
+        collect_handles: bool = False,
+    ):
+        self.resource_rewrites = resource_rewrites
+        self.handle_rewrites = handle_rewrites
+        self.collect_handles = collect_handles
+        self.handles: List[Tuple[str, Optional[str]]] = []
+
+    def _visit_resource_step(self, step: Union[Get, Put], handle_field: str) -> Step:
+        handle = getattr(step, handle_field)
+        update: Dict[str, Any] = {}
+
+        if self.resource_rewrites is not None:
+            resource = self.resource_rewrites[step.effective_resource()]
+            if resource != step.resource:
+                update["resource"] = resource
+        if self.handle_rewrites is not None:
+            if self.handle_rewrites[handle] != handle:
+                update[handle_field] = self.handle_rewrites[handle]
+
+        if update:
+            step = step.copy(update=update)
+        if self.collect_handles:
+            handle = getattr(step, handle_field)
+            self.handles.append((handle, step.effective_resource()))
+        return step
+
+    def visit_get(self, step: Get) -> Get:
+        return self._visit_resource_step(step, "get")
+
+    def visit_put(self, step: Put) -> Put:
+        return self._visit_resource_step(step, "put")
+
+    def visit_task(self, step: Task) -> Task:
+        # ToDo: Why do we need these checks
+        if self.resource_rewrites is not None and step.file:
+            raise Exception(f"No support for file in {step}")
+
+        if self.handle_rewrites is not None:
+            if not step.config:
+                raise Exception(f"Task needs config for {step}")
+
+            input_mapping = {
+                input.name: self.handle_rewrites[input.name]
+                for input in step.config.inputs
+            }
+            output_mapping = {
+                output.name: self.handle_rewrites[output.name]
+                for output in step.config.outputs
+            }
+            if (
+                input_mapping != step.input_mapping
+                or output_mapping != step.output_mapping
+            ):
+                step = step.copy(
+                    update={
+                        "input_mapping": input_mapping,
+                        "output_mapping": output_mapping,
+                    },
+                )
+
+        # Tasks from a file or image without config declare no inputs or outputs here
+        if self.collect_handles and step.config is not None:
+            # ToDo: Consider input_mapping and output_mapping also
+            self.handles.extend((handle.name, None) for handle in step.config.inputs)
+            self.handles.extend((handle.name, None) for handle in step.config.outputs)
+        return step
+
+    def visit_hook(self, step: Step) -> Step:
+        collect_handles = self.collect_handles
+        self.collect_handles = False
+        try:
+            return super().visit_hook(step)
+        finally:
+            self.collect_handles = collect_handles
+
+    def visit_job(self, job: Job) -> Job:
+        handles_start = len(self.handles)
+        new_job = super().visit_job(job)
+        if self.collect_handles:
+            new_job._handles = self.handles[handles_start:]
+        return new_job
+
+
+class _IdentityRewriteCheck(StepVisitor):
+    """Find steps that a resource rewrite changes even when it renames nothing
+
+    Gets and puts that leave their resource implicit have it filled in and tasks
+    from a file are rejected.
+    """
+
+    def __init__(self):
+        self.changes = False
+
+    def visit_get(self, step: Get) -> Get:
+        self.changes = self.changes or not step.resource
+        return step
+
+    def visit_put(self, step: Put) -> Put:
+        self.changes = self.changes or not step.resource
+        return step
+
+    def visit_task(self, step: Task) -> Task:
+        self.changes = self.changes or bool(step.file)
+        return step
+
+
 class LogRetentionPolicy(YamlModel):
     """Log Retention for concoure job
 
@@ -716,7 +1339,7 @@ class LogRetentionPolicy(YamlModel):
     minimum_succeeded_builds: int
 
 
-class Job(YamlModel, RewritesABC):
+class Job(FingerprintModel, RewritesABC):
     name: str
     plan: List[Step]
     old_name: Optional[str] = None
@@ -733,10 +1356,26 @@ class Job(YamlModel, RewritesABC):
     on_abort: Optional[Step] = None
     ensure: Optional[Step] = None
 
+    _handles: Optional[List[Tuple[str, Optional[str]]]] = PrivateAttr(default=None)
+    _identity_rewrite_changes: Optional[bool] = PrivateAttr(default=None)
+
+    @validator("plan", pre=True)
+    def dispatch_plan(cls, value):
+        return _parse_steps(value)
+
+    @validator(*_job_hooks, pre=True)
+    def dispatch_hooks(cls, value):
+        return _parse_step(value)
+
     def __eq__(self, other: Job) -> bool:
+        if self is other:
+            return True
+        if self.fingerprint() != other.fingerprint():
+            return False
+        # Fingerprints match so only a collision can make these differ. Check the
+        # cheap fields before walking the plan
         return (
-            self.plan == other.plan
-            and self.old_name == other.old_name
+            self.old_name == other.old_name
             and self.serial == other.serial
             and self.serial_groups == other.serial_groups
             and self.max_in_flight == other.max_in_flight
@@ -744,74 +1383,67 @@ class Job(YamlModel, RewritesABC):
             and self.public == other.public
             and self.disable_manual_trigger == other.disable_manual_trigger
             and self.interruptible == other.interruptible
+            and self.plan == other.plan
+        )
+
+    def content_key(self) -> Hashable:
+        return (
+            tuple(step.fingerprint() for step in self.plan),
+            self.old_name,
+            self.serial,
+            _freeze(self.serial_groups),
+            self.max_in_flight,
+            _freeze(self.build_log_retention.dict())
+            if self.build_log_retention
+            else None,
+            self.public,
+            self.disable_manual_trigger,
+            self.interruptible,
         )
 
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
     def __lt__(self, other):
         return self.name < other.name
 
+    def _clear_caches(self) -> None:
+        super()._clear_caches()
+        self._handles = None
+        self._identity_rewrite_changes = None
+
+    def identity_rewrite_changes(self) -> bool:
+        """Check if a resource rewrite that renames nothing would change the job"""
+        if self._identity_rewrite_changes is None:
+            check = _IdentityRewriteCheck()
+            check.visit_job(self)
+            self._identity_rewrite_changes = check.changes
+        return self._identity_rewrite_changes
+
     def resource_rewrite(
         self,
         resource_rewrites: Dict[str, str],
     ) -> Job:
-        return self.copy(
-            deep=True,
-            update={
-                "plan": [
-                    step.resource_rewrite(resource_rewrites) for step in self.plan
-                ],
-                "on_success": self.on_success.resource_rewrite(resource_rewrites)
-                if self.on_success
-                else None,
-                "on_failure": self.on_failure.resource_rewrite(resource_rewrites)
-                if self.on_failure
-                else None,
-                "on_error": self.on_error.resource_rewrite(resource_rewrites)
-                if self.on_error
-                else None,
-                "on_abort": self.on_abort.resource_rewrite(resource_rewrites)
-                if self.on_abort
-                else None,
-                "ensure": self.ensure.resource_rewrite(resource_rewrites)
-                if self.ensure
-                else None,
-            },
-        )
+        # Collect the handles on the way past as a deep merge will need them
+        with phase("rewrite", job=self.name):
+            return RewriteVisitor(
+                resource_rewrites=resource_rewrites, collect_handles=True
+            ).visit_job(self)
 
     def handle_rewrite(
         self,
         handle_rewrites: Dict[str, str],
     ) -> Job:
-
-        return self.copy(
-            deep=True,
-            update={
-                "plan": [step.handle_rewrite(handle_rewrites) for step in self.plan],
-                "on_success": self.on_success.handle_rewrite(handle_rewrites)
-                if self.on_success
-                else None,
-                "on_failure": self.on_failure.handle_rewrite(handle_rewrites)
-                if self.on_failure
-                else None,
-                "on_error": self.on_error.handle_rewrite(handle_rewrites)
-                if self.on_error
-                else None,
-                "on_abort": self.on_abort.handle_rewrite(handle_rewrites)
-                if self.on_abort
-                else None,
-                "ensure": self.ensure.handle_rewrite(handle_rewrites)
-                if self.ensure
-                else None,
-            },
-        )
+        return RewriteVisitor(handle_rewrites=handle_rewrites).visit_job(self)
 
     def deep_merge(self, other: Job) -> Job:
 
         # Check rules before we attempt the deep_merge
-        if (
-            self.on_abort != other.on_abort
-            or self.on_error != other.on_error
-            or self.on_failure != other.on_failure
-            or self.on_success != other.on_success
+        if not (
+            _optional_eq(self.on_abort, other.on_abort)
+            and _optional_eq(self.on_error, other.on_error)
+            and _optional_eq(self.on_failure, other.on_failure)
+            and _optional_eq(self.on_success, other.on_success)
         ):
             raise Exception("Cannot merge job if different on_ tasks")
 
@@ -819,19 +1451,18 @@ class Job(YamlModel, RewritesABC):
         if len(self.plan) != len(other.plan):
             raise Exception("deep_merge only when plans are same length")
 
-        return self.copy(
-            deep=True,
-            update={
-                "plan": [
-                    self_plan.deep_merge(other_plan)
-                    for self_plan, other_plan in zip(self.plan, other.plan)
-                ]
-            },
-        )
+        plan = [
+            self_plan.deep_merge(other_plan)
+            for self_plan, other_plan in zip(self.plan, other.plan)
+        ]
+        if all(new is old for new, old in zip(plan, self.plan)):
+            return self
+        return self.copy(update={"plan": plan})
 
     def handles(self) -> List[Tuple[str, str]]:
-        # list_list = [step.handles() for step in self.plan]
-        return [handle for step in self.plan for handle in step.handles()]
+        if self._handles is None:
+            RewriteVisitor(collect_handles=True).visit_job(self)
+        return list(self._handles)
 
     @classmethod
     def resource_rewrites(
@@ -866,20 +1497,52 @@ class Job(YamlModel, RewritesABC):
         return {}
 
 
-class Pipeline(YamlModel):
+class Pipeline(FingerprintModel):
     """Definition of a concourse plan"""
 
     resource_types: list[ResourceType] = Field(default_factory=list)
     resources: list[Resource] = Field(default_factory=list)
     jobs: List[Job] = Field(default_factory=list)
 
+    _exact_key: Optional[Hashable] = PrivateAttr(default=None)
+
     def __eq__(self, other: Pipeline) -> bool:
+        if self is other:
+            return True
+        if self.fingerprint() != other.fingerprint():
+            return False
         return (
             sorted(self.resource_types) == sorted(other.resource_types)
             and sorted(self.resources) == sorted(other.resources)
             and sorted(self.jobs) == sorted(other.jobs)
         )
 
+    def __hash__(self) -> int:
+        return self.fingerprint()
+
+    def content_key(self) -> Hashable:
+        # Merkle root over the fingerprints of the members, paired by name as __eq__
+        return (
+            tuple(item.fingerprint() for item in sorted(self.resource_types)),
+            tuple(item.fingerprint() for item in sorted(self.resources)),
+            tuple(item.fingerprint() for item in sorted(self.jobs)),
+        )
+
+    def _clear_caches(self) -> None:
+        super()._clear_caches()
+        self._exact_key = None
+
+    def exact_key(self) -> Hashable:
+        """Hashable key of the whole content of the pipeline
+
+        Unlike the fingerprint this covers every field, names and the order of every
+        list, so pipelines with equal keys give the same output. Cached like the
+        fingerprint.
+        """
+        if self._exact_key is None:
+            self._exact_key = _exact_content_key(self)
+        return self._exact_key
+
     def exactEq(self, other: Pipeline) -> bool:
         if self != other:
             return False
@@ -901,6 +1564,113 @@ class Pipeline(YamlModel):
             )
         )
 
+    def write_yaml(self, stream: TextIO, compact: bool = False) -> None:
+        """Write the same YAML as :meth:`yaml` to stream one item at a time
+
+        Only one resource type, resource or job is converted at a time rather than
+        the whole document, so a large pipeline is never held as YAML in memory.
+
+        :param compact: Leave out fields holding their default value, as
+            :meth:`compact_yaml`
+        """
+        dumps = self.__config__.yaml_dumps
+        to_dict = _compact_dict if compact else BaseModel.dict
+        written = False
+        for name, field in self.__fields__.items():
+            value = getattr(self, name)
+            if compact and _is_default(field, value):
+                continue
+            if field.shape == SHAPE_LIST and value:
+                stream.write(f"{field.alias}:\n")
+                for item in value:
+                    dumps([to_dict(item)], stream, default_flow_style=False)
+            else:
+                dumps(self.dict(include={name}), stream, default_flow_style=False)
+            written = True
+        if not written:
+            dumps({}, stream, default_flow_style=False)
+
+    def write_json(self, stream: TextIO, compact: bool = False) -> None:
+        """Write the same JSON as :meth:`json` to stream one item at a time
+
+        Items are converted one at a time as in :meth:`write_yaml`. The document is
+        followed by a newline.
+
+        :param compact: Leave out fields holding their default value
+        """
+        dumps = self.__config__.json_dumps
+        encoder = self.__json_encoder__
+        to_dict = _compact_dict if compact else BaseModel.dict
+        separator = "{"
+        for name, field in self.__fields__.items():
+            value = getattr(self, name)
+            if compact and _is_default(field, value):
+                continue
+            stream.write(f"{separator}{dumps(field.alias)}: ")
+            if field.shape == SHAPE_LIST:
+                stream.write("[")
+                for index, item in enumerate(value):
+                    if index:
+                        stream.write(", ")
+                    stream.write(dumps(to_dict(item), default=encoder))
+                stream.write("]")
+            else:
+                stream.write(dumps(self.dict(include={name})[name], default=encoder))
+            separator = ", "
+        stream.write("{}\n" if separator == "{" else "}\n")
+
+    def write(
+        self, stream: TextIO, output_format: str = "yaml", compact: bool = False
+    ) -> None:
+        """Write the pipeline to stream as ``yaml`` or ``json``"""
+        if output_format not in ("json", "yaml"):
+            raise Exception(f"Unknown output format {output_format}")
+        items = len(self.resource_types) + len(self.resources) + len(self.jobs)
+        with phase("write", items=items):
+            if output_format == "json":
+                self.write_json(stream, compact)
+            else:
+                self.write_yaml(stream, compact)
+
+    def compact_yaml(self) -> str:
+        """YAML of the pipeline without the fields that hold their default value
+
+        Parsing the result gives a pipeline equal to this one with the same
+        :meth:`yaml`, in a fraction of the size.
+        """
+        stream = StringIO()
+        self.write_yaml(stream, compact=True)
+        return stream.getvalue()
+
+    @classmethod
+    def parse_any(cls, b: StrBytes) -> Pipeline:
+        """Parse a Pipeline from JSON or YAML
+
+        JSON, such as the output of ``fly get-pipeline --json``, is recognised and
+        read with the JSON parser, which is much faster than the YAML loader used by
+        :meth:`parse_raw`. Anything else is parsed by :meth:`parse_raw`.
+        """
+        with phase("parse", bytes=len(b)):
+            document = _json_document(b)
+            if document is None:
+                return cls.parse_raw(b)
+            return cls.parse_obj(document)
+
+    @classmethod
+    def load_trusted(cls, b: StrBytes) -> Pipeline:
+        """Load a Pipeline from YAML or JSON without validating it
+
+        Skips the model validation done by :meth:`parse_raw` for input that is
+        already known to be valid, such as the output of an earlier merge. Invalid
+        input is not reported here but will fail later or produce invalid output.
+        JSON is recognised as in :meth:`parse_any`.
+        """
+        with phase("parse", bytes=len(b)):
+            document = _json_document(b)
+            if document is None:
+                document = cls.__config__.yaml_loads(b)
+            return _construct_model(cls, document)
+
     def validate(self) -> bool:
         """Check if the Pipeline is valid
 
@@ -940,33 +1710,99 @@ class Pipeline(YamlModel):
             Merged output from combination of both inputs with minimised
             :class:`Resource` s and :class:`ResourceType` s
         """
+        with phase("merge", pipelines=2):
+            with phase("validate", pipelines=2):
+                if not pipeline_left.validate():
+                    raise Exception(f"pipeline_left is not valid: {pipeline_left}")
+
+                if not pipeline_right.validate():
+                    raise Exception(f"pipeline_right is not valid: {pipeline_right}")
 
-        if not pipeline_left.validate():
-            raise Exception(f"pipeline_left is not valid: {pipeline_left}")
+            resource_types = _UniquesIndex(pipeline_left.resource_types)
+            resources = _UniquesIndex(pipeline_left.resources)
+            jobs = _UniquesIndex(pipeline_left.jobs)
+
+            cls._merge_into(resource_types, resources, jobs, pipeline_right, deep)
+
+            return Pipeline(
+                resource_types=resource_types.to_list(),
+                resources=resources.to_list(),
+                jobs=jobs.to_list(),
+            )
+
+    @classmethod
+    def merge_many(cls, pipelines: List[Pipeline], deep: bool = False) -> Pipeline:
+        """Merge any number of Concourse Plans
 
-        if not pipeline_right.validate():
-            raise Exception(f"pipeline_right is not valid: {pipeline_right}")
+        Gives the same result as merging the pipelines one at a time from the left,
+        ie ``merge(merge(merge(p0, p1), p2), p3)``, so earlier pipelines take
+        priority for names. Each pipeline is validated once and the accumulated
+        resource types, resources and jobs are indexed once rather than being rebuilt
+        for every merge.
+
+        :param pipelines: Plans to merge in priority order
+        :param deep: Deep mode attempts to merge jobs based on name and cooerce merges
+            serial and parallel objects
+
+        :Return:
+            Merged output from combination of all inputs with minimised
+            :class:`Resource` s and :class:`ResourceType` s
+        """
+        with phase("merge", pipelines=len(pipelines)):
+            with phase("validate", pipelines=len(pipelines)):
+                for index, pipeline in enumerate(pipelines):
+                    if not pipeline.validate():
+                        raise Exception(f"pipelines[{index}] is not valid: {pipeline}")
+
+            if not pipelines:
+                return Pipeline()
+
+            resource_types = _UniquesIndex(pipelines[0].resource_types)
+            resources = _UniquesIndex(pipelines[0].resources)
+            jobs = _UniquesIndex(pipelines[0].jobs)
+
+            for pipeline_right in pipelines[1:]:
+                cls._merge_into(resource_types, resources, jobs, pipeline_right, deep)
+
+            return Pipeline(
+                resource_types=resource_types.to_list(),
+                resources=resources.to_list(),
+                jobs=jobs.to_list(),
+            )
+
+    @classmethod
+    def _merge_into(
+        cls,
+        resource_types: _UniquesIndex,
+        resources: _UniquesIndex,
+        jobs: _UniquesIndex,
+        pipeline_right: Pipeline,
+        deep: bool = False,
+    ) -> None:
+        """Merge a validated pipeline into the uniques of the pipeline so far"""
 
         # set of resource_types from merge and rewrites of resources to achieve this
-        (
-            resource_types,
-            resource_types_right_rewrites,
-        ) = ResourceType.uniques_and_rewrites(
-            pipeline_left.resource_types, pipeline_right.resource_types
+        resource_types_right_rewrites = ResourceType._add_uniques(
+            resource_types, pipeline_right.resource_types
         )
         for type in _internal_resource_types:
             # Internal rewrites are just pass-thru as there is no variance in them and
             # they are always the same so need no name change during rewrite
             resource_types_right_rewrites[type] = type
 
-        # resource_types updated for resources from RHS
-        resources_right_rewritten = Resource.rewrites(
-            pipeline_right.resources, resource_types_right_rewrites
-        )
+        # resource_types updated for resources from RHS. Skip the walk when no
+        # resource type was renamed
+        if _is_identity(resource_types_right_rewrites):
+            resources_right_rewritten = pipeline_right.resources
+        else:
+            with phase("rewrite:Resource", items=len(pipeline_right.resources)):
+                resources_right_rewritten = Resource.rewrites(
+                    pipeline_right.resources, resource_types_right_rewrites
+                )
 
         # Unique resources and rewrites to achieve this
-        resources, resources_right_rewrites = Resource.uniques_and_rewrites(
-            pipeline_left.resources, resources_right_rewritten
+        resources_right_rewrites = Resource._add_uniques(
+            resources, resources_right_rewritten
         )
 
         # NOT WHAT NEXT
@@ -981,13 +1817,24 @@ class Pipeline(YamlModel):
         #      merges (ONLY when job names match) and then we generate
         #      the set of handle uniques and renames needed for RHS.
 
-        jobs_right_rewritten = Job.resource_rewrites(
-            pipeline_right.jobs, resources_right_rewrites
-        )
+        with phase("rewrite:Job", items=len(pipeline_right.jobs)):
+            if _is_identity(resources_right_rewrites):
+                # No resource renamed so only the jobs that the rewrite would still
+                # change, by filling in implicit resources, need it
+                jobs_right_rewritten = [
+                    job.resource_rewrite(resources_right_rewrites)
+                    if job.identity_rewrite_changes()
+                    else job
+                    for job in pipeline_right.jobs
+                ]
+            else:
+                jobs_right_rewritten = Job.resource_rewrites(
+                    pipeline_right.jobs, resources_right_rewrites
+                )
 
         # # Evaluate the rewrites necessary for clashes if we run a deep merge
         # jobs_right_handles_rewrites  = Job.handle_uniques_and_rewrites(
-        #     pipeline_left.jobs, jobs_right_rewritten
+        #     jobs, jobs_right_rewritten
         # )
 
         # jobs_right_handles_rewritten = Job.handle_rewrites(
@@ -997,8 +1844,4 @@ class Pipeline(YamlModel):
         # for each job in rhs consider to add it based on being net new OR with handle
         # rewrites internal to it (handle rewrites are only scoped to the job at hand)
 
-        jobs, jobs_right_rewrites = Job.uniques_and_rewrites(
-            pipeline_left.jobs, jobs_right_rewritten, deep
-        )
-
-        return Pipeline(resource_types=resource_types, resources=resources, jobs=jobs)
+        Job._add_uniques(jobs, jobs_right_rewritten, deep)
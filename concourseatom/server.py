@@ -0,0 +1,132 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Serve merges from a long running process over a Unix domain socket
+
+A warm server has the models imported and keeps recently parsed inputs and merged
+outputs in memory, so a repeated merge costs little more than sending the files.
+See :mod:`concourseatom.client` for the protocol.
+"""
+
+from __future__ import annotations
+import hashlib
+from io import StringIO
+import os
+import socket
+import socketserver
+import stat
+from typing import Callable, List
+
+from concourseatom.cache import LRUCache
+from concourseatom.client import recv_frame, recv_json, send_frame, send_json
+from concourseatom.models import Pipeline
+
+
+class _MergeHandler(socketserver.BaseRequestHandler):
+    server: MergeServer
+
+    def handle(self):
+        try:
+            request = recv_json(self.request)
+            inputs = [recv_frame(self.request) for _ in range(request["inputs"])]
+        except (ConnectionError, ValueError, KeyError):
+            return
+
+        try:
+            merged = self.server.merge(
+                inputs,
+                request.get("deep", False),
+                request.get("trusted", False),
+                request.get("compact", False),
+                request.get("format", "yaml"),
+            )
+        except Exception as e:
+            send_json(self.request, {"ok": False, "error": f"{type(e).__name__}: {e}"})
+            return
+
+        send_json(self.request, {"ok": True})
+        send_frame(self.request, merged.encode())
+
+
+class MergeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server merging pipelines for :func:`client.merge_remote`
+
+    Each connection is handled in its own thread. Parsed inputs and merged YAML are
+    kept in least recently used caches keyed by the content of the inputs.
+
+    :param socket_path: Path to listen on. A stale socket left by a server that is no
+        longer running is replaced.
+    :param parse_cache_size: Number of parsed inputs to keep
+    :param merge_cache_size: Number of merged outputs to keep
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str,
+        parse_cache_size: int = 1024,
+        merge_cache_size: int = 128,
+    ):
+        self._remove_stale_socket(socket_path)
+        self.parsed = LRUCache(parse_cache_size)
+        self.merged = LRUCache(merge_cache_size)
+        super().__init__(socket_path, _MergeHandler)
+
+    @staticmethod
+    def _remove_stale_socket(socket_path: str) -> None:
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            return
+        # Only a socket can be stale, never remove anything else found there
+        if not stat.S_ISSOCK(mode):
+            raise Exception(f"{socket_path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+                return
+        raise Exception(f"A server is already listening on {socket_path}")
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+    def _load(self, data: bytes, loader: Callable[[bytes], Pipeline]) -> Pipeline:
+        key = (hashlib.sha256(data).digest(), loader.__name__)
+        pipeline = self.parsed.get(key)
+        if pipeline is None:
+            pipeline = loader(data)
+            self.parsed.put(key, pipeline)
+        return pipeline
+
+    def merge(
+        self,
+        inputs: List[bytes],
+        deep: bool,
+        trusted: bool,
+        compact: bool = False,
+        output_format: str = "yaml",
+    ) -> str:
+        """The merge of the content of input files as YAML or JSON"""
+        loader = Pipeline.load_trusted if trusted else Pipeline.parse_any
+        key = (
+            tuple(hashlib.sha256(data).digest() for data in inputs),
+            deep,
+            trusted,
+            compact,
+            output_format,
+        )
+        merged = self.merged.get(key)
+        if merged is None:
+            pipelines = [self._load(data, loader) for data in inputs]
+            output = StringIO()
+            Pipeline.merge_many(pipelines, deep=deep).write(
+                output, output_format, compact
+            )
+            merged = output.getvalue()
+            self.merged.put(key, merged)
+        return merged
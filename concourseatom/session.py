@@ -0,0 +1,352 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Merge of a list of pipelines that is updated incrementally as inputs change
+
+A :class:`MergeSession` keeps versioned indexes of the merged resource types,
+resources and jobs that remember which input made each change, so replacing one
+input only merges again the inputs it affects.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from concourseatom.models import Pipeline, RewritesABC
+
+
+class _MergeRecord:
+    """Lookups and changes made to the indexes while merging one input"""
+
+    def __init__(self):
+        self.reads: Set[Hashable] = set()
+        self.ops: List[Tuple] = []
+
+
+class _Entry:
+    """Item of a :class:`_VersionedIndex` with the inputs that added and removed it"""
+
+    __slots__ = ("item", "order", "removed")
+
+    def __init__(self, item: RewritesABC, order: Tuple[int, int]):
+        self.item = item
+        self.order = order
+        self.removed: Optional[int] = None
+
+    def visible(self, position: int) -> bool:
+        return self.order[0] <= position and (
+            self.removed is None or self.removed > position
+        )
+
+
+class _VersionedNames:
+    """NameRegistry view of a :class:`_VersionedIndex` as of its current position"""
+
+    def __init__(self, index: _VersionedIndex):
+        self._index = index
+
+    def __contains__(self, name: str) -> bool:
+        index = self._index
+        index._read("name", name)
+        return any(added <= index.position for added in index._names.get(name, ()))
+
+    def allocate(self, name: str) -> str:
+        # Allocates the same names as NameRegistry, probing from -000 unless every
+        # suffix below the one remembered for name is known to be taken
+        index = self._index
+        index_num = 0
+        hint = index._next_index.get(name)
+        if hint is not None and hint[1] <= index.position:
+            index_num = hint[0]
+            # Skipped names are looked up as one, any change to them changes this
+            index._read("base", name)
+        b_alt_name = f"{name}-{index_num:0>3}"
+        while b_alt_name in self:
+            index_num += 1
+            b_alt_name = f"{name}-{index_num:0>3}"
+        index._register(b_alt_name)
+        index._write("allocate", b_alt_name)
+        index._next_index[name] = (index_num + 1, index.position)
+        return b_alt_name
+
+
+def _name_base(name: str) -> Optional[str]:
+    """Name that allocating an alternative for could give name, if any"""
+    base, separator, suffix = name.rpartition("-")
+    if separator and len(suffix) >= 3 and suffix.isdigit():
+        return base
+    return None
+
+
+class _VersionedIndex:
+    """_UniquesIndex holding the uniques of every stage of a sequence of merges
+
+    Entries remember the position of the input that added them and of the input that
+    removed them, so lookups made while merging the input at ``position`` see the
+    index as it was after merging the inputs before it, and the changes made by one
+    input can be undone without disturbing the others. Lookups and changes are
+    recorded to ``record`` when it is set.
+    """
+
+    def __init__(self, tag: str):
+        self.tag = tag
+        self.position = 0
+        self.record: Optional[_MergeRecord] = None
+        self.names = _VersionedNames(self)
+        self._next_seq = 0
+        self._by_key: Dict[int, List[_Entry]] = {}
+        self._by_name: Dict[str, List[_Entry]] = {}
+        self._names: Dict[str, List[int]] = {}
+        self._added: Dict[int, List[_Entry]] = {}
+        self._removed: Dict[int, List[_Entry]] = {}
+        self._registered: Dict[int, List[str]] = {}
+        # Next suffix to try for each base name and the position from which every
+        # suffix below it is taken
+        self._next_index: Dict[str, Tuple[int, int]] = {}
+
+    def _read(self, kind: str, value: Hashable) -> None:
+        if self.record is not None:
+            self.record.reads.add((self.tag, kind, value))
+
+    def _write(self, kind: str, value: Any) -> None:
+        if self.record is not None:
+            self.record.ops.append((self.tag, kind, value))
+
+    def _register(self, name: str) -> None:
+        self._names.setdefault(name, []).append(self.position)
+        self._registered.setdefault(self.position, []).append(name)
+
+    def _first(self, entries: List[_Entry]) -> Optional[_Entry]:
+        visible = [entry for entry in entries if entry.visible(self.position)]
+        return min(visible, key=lambda entry: entry.order) if visible else None
+
+    def append(self, item: RewritesABC) -> None:
+        entry = _Entry(item, (self.position, self._next_seq))
+        self._next_seq += 1
+        self._by_key.setdefault(item.fingerprint(), []).append(entry)
+        self._by_name.setdefault(item.name, []).append(entry)
+        self._added.setdefault(self.position, []).append(entry)
+        self._register(item.name)
+        self._write("append", item)
+
+    def find_equal(self, item: RewritesABC) -> Optional[RewritesABC]:
+        """First item which is equal (ignoring name) to item"""
+        key = item.fingerprint()
+        self._read("fp", key)
+        for entry in sorted(self._by_key.get(key, []), key=lambda entry: entry.order):
+            if entry.visible(self.position) and entry.item == item:
+                return entry.item
+        return None
+
+    def find_named(self, name: str) -> Optional[RewritesABC]:
+        """First item with the given name"""
+        self._read("name", name)
+        entry = self._first(self._by_name.get(name, []))
+        return entry.item if entry else None
+
+    def remove(self, item: RewritesABC) -> None:
+        """Remove the first item that is, or is equal to, item"""
+        entry = self._first(
+            [
+                entry
+                for entry in self._by_key[item.fingerprint()]
+                if entry.item is item or entry.item == item
+            ]
+        )
+        entry.removed = self.position
+        self._removed.setdefault(self.position, []).append(entry)
+        self._write("remove", entry.item)
+
+    def undo(self, position: int) -> Set[Hashable]:
+        """Drop the changes made by the input at position
+
+        Returns the keys of the items it added that later inputs removed, as those
+        inputs must then be merged again.
+        """
+        stranded: Set[Hashable] = set()
+        for entry in self._added.pop(position, []):
+            self._by_key[entry.item.fingerprint()].remove(entry)
+            self._by_name[entry.item.name].remove(entry)
+            if entry.removed is not None:
+                stranded.add((self.tag, "fp", entry.item.fingerprint()))
+                stranded.add((self.tag, "name", entry.item.name))
+        for entry in self._removed.pop(position, []):
+            if entry.removed == position:
+                entry.removed = None
+        for name in self._registered.pop(position, []):
+            self._names[name].remove(position)
+        self._next_index = {
+            name: hint for name, hint in self._next_index.items() if hint[1] < position
+        }
+        return stranded
+
+    def to_list(self) -> List[RewritesABC]:
+        entries = [
+            entry
+            for entries in self._added.values()
+            for entry in entries
+            if entry.removed is None
+        ]
+        return [entry.item for entry in sorted(entries, key=lambda e: e.order)]
+
+
+def _op_writes(ops: List[Tuple]) -> Dict[Hashable, List[Tuple]]:
+    """Group changes by the keys of the lookups they can affect"""
+    writes: Dict[Hashable, List[Tuple]] = {}
+    for op in ops:
+        tag, kind, value = op
+        if kind == "allocate":
+            keys = [(tag, "name", value)]
+        else:
+            keys = [(tag, "fp", value.fingerprint()), (tag, "name", value.name)]
+        base = _name_base(keys[-1][2])
+        if base is not None:
+            keys.append((tag, "base", base))
+        for key in keys:
+            writes.setdefault(key, []).append(op)
+    return writes
+
+
+def _same_op(left: Tuple, right: Tuple) -> bool:
+    if left[:2] != right[:2]:
+        return False
+    if left[1] == "allocate":
+        return left[2] == right[2]
+    # Equal items may still be written out differently so compare what is written
+    return left[2] is right[2] or (
+        left[2].fingerprint() == right[2].fingerprint()
+        and left[2].json() == right[2].json()
+    )
+
+
+def _changed_keys(old_ops: List[Tuple], new_ops: List[Tuple]) -> Set[Hashable]:
+    old_writes = _op_writes(old_ops)
+    new_writes = _op_writes(new_ops)
+    return {
+        key
+        for key in old_writes.keys() | new_writes.keys()
+        if len(old_writes.get(key, [])) != len(new_writes.get(key, []))
+        or not all(map(_same_op, old_writes.get(key, []), new_writes.get(key, [])))
+    }
+
+
+class MergeSession:
+    """Merge of a list of pipelines that is updated incrementally as inputs change
+
+    Gives the same result as :meth:`Pipeline.merge_many` of the inputs. The indexes of
+    the merged resource types, resources and jobs keep the changes made by each
+    input along with the fingerprints and names each input looked up. When an input
+    is replaced only its changes are undone and redone. A later input is merged again
+    only if a fingerprint or name it looked up has changed, which includes any name
+    allocation that could come out differently, otherwise its changes are kept as
+    they are.
+
+    :param pipelines: Plans to merge in priority order
+    :param deep: Deep mode attempts to merge jobs based on name and cooerce merges
+        serial and parallel objects
+    """
+
+    def __init__(self, pipelines: Iterable[Pipeline] = (), deep: bool = False):
+        self.deep = deep
+        self._pipelines: List[Pipeline] = []
+        self._records: List[_MergeRecord] = []
+        self._indexes = (
+            _VersionedIndex("resource_types"),
+            _VersionedIndex("resources"),
+            _VersionedIndex("jobs"),
+        )
+        #: Positions of the inputs merged by the last update
+        self.recomputed: List[int] = []
+        for pipeline in pipelines:
+            self.append(pipeline)
+
+    def __len__(self) -> int:
+        return len(self._pipelines)
+
+    @staticmethod
+    def _validate(position: int, pipeline: Pipeline) -> None:
+        if not pipeline.validate():
+            raise Exception(f"pipelines[{position}] is not valid: {pipeline}")
+
+    def _merge(self, position: int, pipeline: Pipeline) -> _MergeRecord:
+        record = _MergeRecord()
+        for index in self._indexes:
+            index.position = position
+            index.record = record
+        try:
+            if position == 0:
+                for index, items in zip(
+                    self._indexes,
+                    (pipeline.resource_types, pipeline.resources, pipeline.jobs),
+                ):
+                    for item in items:
+                        index.append(item)
+            else:
+                Pipeline._merge_into(*self._indexes, pipeline, self.deep)
+        except BaseException:
+            self._undo(position)
+            raise
+        finally:
+            for index in self._indexes:
+                index.record = None
+        return record
+
+    def _undo(self, position: int) -> Set[Hashable]:
+        stranded: Set[Hashable] = set()
+        for index in self._indexes:
+            stranded |= index.undo(position)
+        return stranded
+
+    def append(self, pipeline: Pipeline) -> None:
+        """Merge another pipeline with a lower priority than those already merged"""
+        position = len(self._pipelines)
+        self._validate(position, pipeline)
+        self._records.append(self._merge(position, pipeline))
+        self._pipelines.append(pipeline)
+        self.recomputed = [position]
+
+    def replace(self, position: int, pipeline: Pipeline) -> None:
+        """Replace the pipeline at position and update the merge
+
+        If the merge fails the session is left with the inputs from before the call.
+        """
+        position = range(len(self._pipelines))[position]
+        self._validate(position, pipeline)
+        pipelines = self._pipelines.copy()
+        pipelines[position] = pipeline
+
+        changed: Set[Hashable] = set()
+        recomputed: List[int] = []
+        for later in range(position, len(pipelines)):
+            record = self._records[later]
+            if later == position or not record.reads.isdisjoint(changed):
+                changed |= self._undo(later)
+                try:
+                    new_record = self._merge(later, pipelines[later])
+                except BaseException:
+                    self._restore(position)
+                    raise
+                changed |= _changed_keys(record.ops, new_record.ops)
+                self._records[later] = new_record
+                recomputed.append(later)
+
+        self._pipelines = pipelines
+        self.recomputed = recomputed
+
+    def _restore(self, position: int) -> None:
+        """Merge the current inputs from position onwards again after a failed update
+
+        Inputs merged before the update may depend on those it changed in ways their
+        records no longer show, so every input from position is merged again from
+        the state of the inputs before it, which the update did not touch.
+        """
+        for later in range(position, len(self._pipelines)):
+            self._undo(later)
+        for later in range(position, len(self._pipelines)):
+            self._records[later] = self._merge(later, self._pipelines[later])
+
+    def pipeline(self) -> Pipeline:
+        """The merge of the current inputs"""
+        resource_types, resources, jobs = self._indexes
+        return Pipeline(
+            resource_types=resource_types.to_list(),
+            resources=resources.to_list(),
+            jobs=jobs.to_list(),
+        )
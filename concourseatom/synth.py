@@ -0,0 +1,230 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Generate synthetic pipelines of any size for benchmarking
+
+Pipelines are built from a seeded random number generator so the same
+:class:`SynthConfig` always gives the same pipeline. Sets of snippets for merging
+can share resource and job names with different content (collisions, which the
+merge renames) and resources with the same content under different names
+(duplicates, which the merge combines and rewrites references to).
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, replace
+import random
+from typing import Any, Dict, List, Tuple
+
+from concourseatom.models import Pipeline
+
+_images = ["busybox", "alpine", "ubuntu", "golang", "python", "node"]
+_commands = ["make", "pytest", "go", "npm", "sh", "bash"]
+
+
+@dataclass
+class SynthConfig:
+    """Shape of a synthetic pipeline
+
+    :param resource_types: Number of resource types
+    :param resources: Number of resources
+    :param jobs: Number of jobs
+    :param plan_steps: Number of steps in the plan of each job
+    :param max_depth: Deepest nesting of ``in_parallel`` and ``do`` steps
+    :param nesting_rate: Chance that a step is an ``in_parallel`` or ``do`` of more
+        steps rather than a ``get``, ``put`` or ``task``, while max_depth allows
+    :param collision_rate: Chance that a resource, resource type or job takes its
+        name from a pool shared by every seed, with content of its own. Jobs named
+        from the pool have no hooks and every step of their plan is an
+        ``in_parallel`` so that a deep merge can combine them.
+    :param duplicate_rate: Chance that a resource or resource type takes its
+        content from a pool shared by every seed, with a name of its own
+    :param seed: Seed for the random number generator
+    """
+
+    resource_types: int = 5
+    resources: int = 50
+    jobs: int = 100
+    plan_steps: int = 4
+    max_depth: int = 2
+    nesting_rate: float = 0.3
+    collision_rate: float = 0.0
+    duplicate_rate: float = 0.0
+    seed: int = 0
+
+
+class _Synthesizer:
+    def __init__(self, config: SynthConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.prefix = f"s{config.seed}"
+
+    def _name(
+        self, kind: str, index: int, pool_size: int, used: set
+    ) -> Tuple[str, bool]:
+        """Name for an item and whether it was taken from the shared pool"""
+        if self.random.random() < self.config.collision_rate:
+            name = f"{kind}-{self.random.randrange(pool_size)}"
+            if name not in used:
+                used.add(name)
+                return name, True
+        name = f"{self.prefix}-{kind}-{index}"
+        used.add(name)
+        return name, False
+
+    def _content_random(
+        self, kind: str, pool_size: int, shared: bool = False
+    ) -> random.Random:
+        """Generator for content shared by every seed, or for this seed only
+
+        With shared the first content of the pool is always used.
+        """
+        if shared:
+            index = 0
+        elif self.random.random() < self.config.duplicate_rate:
+            index = self.random.randrange(pool_size)
+        else:
+            return self.random
+        # Seeded independently of config.seed so every seed draws the same pool
+        return random.Random(f"{kind}-{index}")
+
+    def resource_type(self, index: int, used: set) -> Dict[str, Any]:
+        name, _ = self._name("type", index, self.config.resource_types, used)
+        # Shared resources use the first type so it is shared too when they exist
+        rng = self._content_random(
+            "type",
+            self.config.resource_types,
+            shared=index == 0 and self.config.duplicate_rate > 0,
+        )
+        resource_type = {
+            "name": name,
+            "type": "registry-image",
+            "source": {
+                "repository": f"example/resource-{rng.randrange(1_000_000)}",
+                "tag": rng.choice(["latest", "stable", "1.0"]),
+            },
+        }
+        if rng.random() < 0.2:
+            resource_type["check_every"] = rng.choice(["10m", "1h", "24h"])
+        return resource_type
+
+    def resource(self, index: int, types: List[str], used: set) -> Dict[str, Any]:
+        name, _ = self._name("resource", index, self.config.resources, used)
+        rng = self._content_random("resource", self.config.resources)
+        resource = {
+            "name": name,
+            "type": types[0] if rng is not self.random else rng.choice(types),
+            "source": {
+                "uri": f"https://example.com/repo-{rng.randrange(1_000_000)}.git",
+                "branch": rng.choice(["main", "develop", "release"]),
+            },
+        }
+        if rng.random() < 0.3:
+            resource["icon"] = rng.choice(["github", "docker", "package"])
+        if rng.random() < 0.2:
+            resource["check_every"] = rng.choice(["5m", "30m", "1h"])
+        return resource
+
+    def step(
+        self, depth: int, resources: List[str], passed: List[str]
+    ) -> Dict[str, Any]:
+        rng = self.random
+        if depth < self.config.max_depth and rng.random() < self.config.nesting_rate:
+            steps = [
+                self.step(depth + 1, resources, passed)
+                for _ in range(rng.randint(2, 4))
+            ]
+            if rng.random() < 0.5:
+                return {"do": steps}
+            if rng.random() < 0.5:
+                return {"in_parallel": steps}
+            return {"in_parallel": {"steps": steps, "fail_fast": True}}
+
+        kind = rng.random()
+        if kind < 0.45:
+            get = {"get": rng.choice(resources)}
+            if rng.random() < 0.5:
+                get["trigger"] = True
+            if passed and rng.random() < 0.3:
+                get["passed"] = rng.sample(passed, min(len(passed), 2))
+            return get
+        if kind < 0.65:
+            put = {"put": rng.choice(resources)}
+            if rng.random() < 0.5:
+                put["params"] = {"repository": rng.choice(resources)}
+            return put
+        return {
+            "task": rng.choice(["build", "test", "lint", "package", "deploy"]),
+            "config": {
+                "platform": "linux",
+                "image_resource": {
+                    "type": "registry-image",
+                    "source": {"repository": rng.choice(_images)},
+                },
+                "run": {
+                    "path": rng.choice(_commands),
+                    "args": [f"--target={rng.randrange(100)}"],
+                },
+                "inputs": [{"name": name} for name in rng.sample(resources, 1)],
+            },
+        }
+
+    def job(
+        self, index: int, resources: List[str], passed: List[str], used: set
+    ) -> Dict[str, Any]:
+        name, pooled = self._name("job", index, self.config.jobs, used)
+        plan = [self.step(0, resources, passed) for _ in range(self.config.plan_steps)]
+        job: Dict[str, Any] = {"name": name}
+        if pooled:
+            job["plan"] = [{"in_parallel": [step]} for step in plan]
+        else:
+            job["plan"] = plan
+        if self.random.random() < 0.2:
+            job["serial"] = True
+        if not pooled and self.random.random() < 0.2:
+            job["on_failure"] = {"put": self.random.choice(resources)}
+        return job
+
+    def data(self) -> Dict[str, Any]:
+        used: set = set()
+        resource_types = [
+            self.resource_type(index, used)
+            for index in range(self.config.resource_types)
+        ]
+        # time is built in so a pipeline without resource types is still valid
+        types = [resource_type["name"] for resource_type in resource_types] or ["time"]
+
+        resources = [
+            self.resource(index, types, used) for index in range(self.config.resources)
+        ]
+        names = [resource["name"] for resource in resources]
+
+        jobs: List[Dict[str, Any]] = []
+        if names:
+            for index in range(self.config.jobs):
+                passed = [job["name"] for job in jobs[-5:]]
+                jobs.append(self.job(index, names, passed, used))
+
+        return {"resource_types": resource_types, "resources": resources, "jobs": jobs}
+
+
+def synth_data(config: SynthConfig = SynthConfig()) -> Dict[str, Any]:
+    """Raw data of a synthetic pipeline, as loaded from YAML or JSON
+
+    Jobs are only generated when there are resources for their steps to use.
+    """
+    return _Synthesizer(config).data()
+
+
+def synth_pipeline(config: SynthConfig = SynthConfig()) -> Pipeline:
+    """Synthetic pipeline, see :class:`SynthConfig`"""
+    return Pipeline.parse_obj(synth_data(config))
+
+
+def synth_pipelines(count: int, config: SynthConfig = SynthConfig()) -> List[Pipeline]:
+    """Synthetic snippets to merge, seeded from config.seed upwards
+
+    Names that are not drawn from the shared pool include the seed, so the snippets
+    only collide and duplicate each other at the rates in config.
+    """
+    return [
+        synth_pipeline(replace(config, seed=config.seed + index))
+        for index in range(count)
+    ]
@@ -0,0 +1,150 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Pluggable hooks around the phases of loading, merging and writing pipelines
+
+Code marks a phase with ``with phase("name", items=n):``. When no hook is installed
+this costs one context variable lookup, so phases can mark hot loops. A hook is a
+callable taking the phase name and its arguments, such as item counts, and returning
+a context manager that is entered around the phase. Hooks are installed with
+:func:`phase_hook` for the current thread (or asyncio task) only.
+"""
+
+from __future__ import annotations
+from contextlib import ExitStack, contextmanager, nullcontext
+from contextvars import ContextVar
+import time
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+PhaseHook = Callable[[str, Dict[str, Any]], ContextManager]
+
+_hook: ContextVar[Optional[PhaseHook]] = ContextVar("phase_hook", default=None)
+_no_hook = nullcontext()
+
+
+def phase(name: str, **args: Any) -> ContextManager:
+    """Context manager marking a phase for the installed hooks
+
+    :param name: Name of the phase, nested phases are reported within it
+    :param args: Details of the phase. Integers are counts of the items the phase
+        works on, by kind.
+    """
+    hook = _hook.get()
+    if hook is None:
+        return _no_hook
+    return hook(name, args)
+
+
+@contextmanager
+def phase_hook(hook: PhaseHook) -> Iterator[PhaseHook]:
+    """Install hook for the phases within the block
+
+    A hook installed inside the block of another runs inside it for each phase, so
+    both see every phase.
+    """
+    outer = _hook.get()
+    if outer is None:
+        combined = hook
+    else:
+
+        @contextmanager
+        def combined(name: str, args: Dict[str, Any]):
+            with ExitStack() as stack:
+                stack.enter_context(outer(name, args))
+                stack.enter_context(hook(name, args))
+                yield
+
+    token = _hook.set(combined)
+    try:
+        yield hook
+    finally:
+        _hook.reset(token)
+
+
+def tree_order(paths: Iterable[Tuple[str, ...]]) -> List[Tuple[str, ...]]:
+    """Paths of nested phases with children after their parent, in first seen order"""
+    paths = list(paths)
+    order = {path: index for index, path in enumerate(paths)}
+    return sorted(
+        paths,
+        key=lambda path: tuple(
+            order.get(path[: depth + 1], 0) for depth in range(len(path))
+        ),
+    )
+
+
+def format_table(rows: List[Tuple[str, ...]], align: str) -> List[str]:
+    """Lines of rows in columns aligned by align, ``<`` for left and ``>`` for right"""
+    widths = [max(len(row[column]) for row in rows) for column in range(len(align))]
+    return [
+        "  ".join(
+            f"{cell:{side}{width}}" for cell, side, width in zip(row, align, widths)
+        ).rstrip()
+        for row in rows
+    ]
+
+
+class _PhaseStats:
+    __slots__ = ("calls", "seconds", "counts")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.counts: Dict[str, int] = {}
+
+
+class PhaseTimer:
+    """Hook totalling the time, calls and item counts of each phase
+
+    Arguments of phases that are not integer counts are ignored.
+
+    Phases are keyed by their path of nested phase names so the same phase within
+    different parents is reported separately. Use as the hook of
+    :func:`phase_hook`.
+    """
+
+    def __init__(self):
+        self.stats: Dict[Tuple[str, ...], _PhaseStats] = {}
+        self._path: Tuple[str, ...] = ()
+
+    @contextmanager
+    def __call__(self, name: str, args: Dict[str, Any]):
+        parent = self._path
+        self._path = path = parent + (name,)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._path = parent
+            stats = self.stats.get(path)
+            if stats is None:
+                stats = self.stats[path] = _PhaseStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            for kind, count in args.items():
+                if isinstance(count, int):
+                    stats.counts[kind] = stats.counts.get(kind, 0) + count
+
+    def report(self) -> str:
+        """Table of the phases, nested phases indented below their parent"""
+        rows: List[Tuple[str, str, str, str]] = [("phase", "calls", "seconds", "items")]
+        for path in tree_order(self.stats):
+            stats = self.stats[path]
+            rows.append(
+                (
+                    "  " * (len(path) - 1) + path[-1],
+                    str(stats.calls),
+                    f"{stats.seconds:.4f}",
+                    " ".join(f"{kind}={count}" for kind, count in stats.counts.items()),
+                )
+            )
+        return "\n".join(format_table(rows, "<>><"))
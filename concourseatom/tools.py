@@ -2,10 +2,14 @@
 # concourseatom Copyright (C) 2022 Ben Greene
 """CLI tools for working with concourse objects
 """
+from contextlib import contextmanager
 import sys
 import click
 
-from concourseatom.models import Pipeline
+# Only modules that are quick to import belong here. Importing the models (pydantic,
+# ruamel and building every model class) is most of the start up time so the commands
+# that need them import them themselves, keeping --help and the server client fast.
+from concourseatom.client import MergeServerError, default_socket_path, merge_remote
 
 # ------------- CLI Boiler plate here -------------
 
@@ -62,22 +66,264 @@ def read_file(ctx, infile):
     click.echo(input_file.decode())
 
 
+@contextmanager
+def open_output(output):
+    """Open a text file for writing or stdout for -
+
+    The file is written beside output then renamed over it when the block succeeds,
+    so a failed merge leaves any previous output in place.
+    """
+    if output == "-":
+        yield sys.stdout
+        return
+
+    import os
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as out:
+            yield out
+        # mkstemp creates the file private, give it the mode open would have
+        try:
+            mode = os.stat(output).st_mode & 0o777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def profiled(profile, profile_file):
+    """Report on the phases run in the block or profile it with cProfile
+
+    :param profile: None to do neither, ``phases`` or ``cprofile``
+    :param profile_file: Where cProfile writes its pstats
+    """
+    if profile is None:
+        yield
+    elif profile == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            click.echo(f"Profile written to {profile_file}", err=True)
+    else:
+        from concourseatom.timing import PhaseTimer, phase, phase_hook
+
+        timer = PhaseTimer()
+        try:
+            with phase_hook(timer), phase("total"):
+                yield
+        finally:
+            click.echo(timer.report(), err=True)
+
+
+@contextmanager
+def memory_reported(memory_report):
+    """Report the peak memory of the phases run in the block and the live models
+
+    Memory is traced with tracemalloc, which slows everything down considerably.
+    """
+    if not memory_report:
+        yield
+        return
+
+    import tracemalloc
+    from concourseatom.memory import MemoryTracker
+    from concourseatom.timing import phase, phase_hook
+
+    tracker = MemoryTracker()
+    tracemalloc.start()
+    try:
+        with phase_hook(tracker), phase("total"):
+            yield
+    finally:
+        tracemalloc.stop()
+        click.echo(tracker.report(), err=True)
+
+
+@contextmanager
+def traced(trace_file):
+    """Record the phases run in the block to trace_file, if given
+
+    The tracer is yielded so spans recorded elsewhere, such as in worker processes,
+    can be added to it.
+    """
+    if trace_file is None:
+        yield None
+        return
+
+    from concourseatom.timing import phase_hook
+    from concourseatom.trace import Tracer
+
+    tracer = Tracer()
+    try:
+        with phase_hook(tracer):
+            yield tracer
+    finally:
+        with open(trace_file, "w", encoding="utf-8") as f:
+            tracer.write(f)
+        click.echo(f"Trace written to {trace_file}", err=True)
+
+
 @cli.command()
 @click.pass_context
 @click.argument(
-    "infile0", type=click.File("rb"), default=sys.stdin
-)  # , help="File to load as first file for merge")
-@click.argument(
-    "infile1", type=click.File("rb")
-)  # , help="File to load as second file for merge")
+    "infiles", nargs=-1, required=True, type=click.File("rb")
+)  # , help="Files to load for merge in priority order")
 @click.option(
     "--deep", is_flag=True, help="Attempt to perform a deep merge of parallel elements"
 )
-def merge(ctx, infile0, infile1, deep):
+@click.option(
+    "--trusted",
+    is_flag=True,
+    help="Skip validation of inputs that are known to be valid, eg earlier output",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    envvar="CONCOURSEATOM_CACHE_DIR",
+    default=None,
+    help="Directory to cache inputs and output in [default: ~/.cache/concourseatom]",
+)
+@click.option("--no-cache", is_flag=True, help="Parse and merge without the cache")
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running and merge again each time an input file changes",
+)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1.0,
+    show_default=True,
+    help="Seconds between checks for changed files with --watch",
+)
+@click.option(
+    "--server",
+    "server_socket",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Merge in the server started by `concmerge serve` listening on this socket",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    default="-",
+    help="File to write the merged pipeline to [default: stdout]",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Leave out fields that hold their default value",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["yaml", "json"]),
+    default="yaml",
+    show_default=True,
+    help="Format to write the merged pipeline in",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["phases", "cprofile"]),
+    is_flag=False,
+    flag_value="phases",
+    default=None,
+    help="Report the time and items of each phase on stderr, or with"
+    " --profile=cprofile profile with cProfile. Implies --no-cache. Give the mode"
+    " after an = or put --profile after the files",
+)
+@click.option(
+    "--profile-file",
+    type=click.Path(dir_okay=False),
+    default="concmerge.pstats",
+    show_default=True,
+    help="File for the pstats of --profile=cprofile",
+)
+@click.option(
+    "--trace",
+    "trace_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write spans of each phase to this file as a Chrome trace for Perfetto."
+    " Implies --no-cache",
+)
+@click.option(
+    "--memory-report",
+    is_flag=True,
+    help="Report the peak memory of each phase and the live models on stderr."
+    " Implies --no-cache",
+)
+def merge(
+    ctx,
+    infiles,
+    deep,
+    trusted,
+    cache_dir,
+    no_cache,
+    watch,
+    interval,
+    server_socket,
+    output,
+    compact,
+    output_format,
+    profile,
+    profile_file,
+    trace_file,
+    memory_report,
+):
     """
-    Merge two concourse jobs and resources
+    Merge concourse jobs and resources
+
+    Read input from stdin and one named file or from two or more files. Inputs may
+    be YAML or JSON, such as the output of `fly get-pipeline --json`, which is
+    recognised and parsed much faster than YAML. Files are merged in a single pass
+    in the order given with earlier files taking priority for names, giving the
+    same result as merging them one pair at a time.
+
+    Parsed inputs and merged output are cached on disk keyed by the content of the
+    inputs so unchanged files are neither parsed nor merged again.
+
+    With --server the files are sent to a running `concmerge serve` to merge.
+
+    With --watch the files are kept parsed in memory and polled for changes. Each
+    time one changes only that file is parsed again and the merged pipeline is
+    written out again, replacing the output file or as a new document on stdout.
 
-    Read input from stdin and named file or from two files.
+    With --profile the time spent parsing, validating, finding the unique resource
+    types, resources and jobs, rewriting references to them and writing out is
+    reported on stderr along with the number of items in each phase.
+    --profile=cprofile instead saves a cProfile of the merge to --profile-file.
+    The cache is not used when profiling, as a hit would skip the merge.
+
+    With --trace the same phases, down to each job rewritten and deep merged, are
+    saved as a Chrome trace to open in https://ui.perfetto.dev. Like --profile it
+    does not use the cache.
+
+    With --memory-report the peak memory allocated in each phase, and what it left
+    allocated, is reported on stderr along with the number of live instances of each
+    model class once the merge is done. Memory tracing makes the merge much slower.
+    Like --profile it does not use the cache.
+
+    The merged pipeline is written out as YAML, or JSON with --format json, as it is
+    converted rather than being built up in memory first. With --compact fields
+    holding their default value are left out, which parses back to the same
+    pipeline.
 
     Merge will first try to merge the resource types based on the content not on the
     name.
@@ -86,16 +332,273 @@ def merge(ctx, infile0, infile1, deep):
     configuration.
 
     """
+    if watch and server_socket:
+        raise click.UsageError("--watch cannot be used with --server")
+    if profile and (watch or server_socket):
+        raise click.UsageError("--profile cannot be used with --watch or --server")
+    if trace_file and (watch or server_socket):
+        raise click.UsageError("--trace cannot be used with --watch or --server")
+    if memory_report and (watch or server_socket):
+        raise click.UsageError(
+            "--memory-report cannot be used with --watch or --server"
+        )
+
+    if len(infiles) == 1:
+        if watch:
+            raise click.UsageError("--watch needs two or more files")
+        infiles = (click.get_binary_stream("stdin"),) + infiles
+
     if ctx.obj["DEBUG"]:
-        click.echo(f"Starting to merge0 {infile0.name}", err=True)
-        click.echo(f"Starting to merge1 {infile1.name}", err=True)
+        for index, infile in enumerate(infiles):
+            click.echo(f"Starting to merge{index} {infile.name}", err=True)
+
+    if server_socket:
+        inputs = [infile.read() for infile in infiles]
+        try:
+            merged = merge_remote(
+                inputs, deep, trusted, server_socket, compact, output_format
+            )
+        except (OSError, MergeServerError) as e:
+            raise click.ClickException(f"Merge in server {server_socket} failed: {e}")
+        with open_output(output) as out:
+            out.write(merged)
+        return
+
+    from concourseatom.models import Pipeline
+
+    load = Pipeline.load_trusted if trusted else Pipeline.parse_any
+
+    if watch:
+        from concourseatom.watch import watch_merge
+
+        first = True
+
+        def on_merge(merged):
+            nonlocal first
+            with open_output(output) as out:
+                # JSON documents are one to a line so only YAML needs a separator
+                if output == "-" and not first and output_format == "yaml":
+                    out.write("---\n")
+                merged.write(out, output_format, compact)
+                out.flush()
+            first = False
+
+        def on_error(path, e):
+            click.echo(f"Failed to merge {path}: {e}", err=True)
+
+        try:
+            watch_merge(
+                [infile.name for infile in infiles],
+                on_merge,
+                on_error,
+                deep=deep,
+                loader=load,
+                interval=interval,
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    inputs = [infile.read() for infile in infiles]
+
+    if profile or trace_file or memory_report:
+        # A cache hit skips every phase worth measuring
+        no_cache = True
+
+    with traced(trace_file), profiled(profile, profile_file), memory_reported(
+        memory_report
+    ), open_output(output) as out:
+        if no_cache:
+            merged = Pipeline.merge_many([load(data) for data in inputs], deep=deep)
+            merged.write(out, output_format, compact)
+        else:
+            from concourseatom.cache import MergeCache
+
+            MergeCache(cache_dir).write_merge(
+                inputs,
+                out,
+                deep=deep,
+                loader=load,
+                compact=compact,
+                output_format=output_format,
+            )
+
+
+@cli.command()
+@click.pass_context
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    default=default_socket_path,
+    show_default="$CONCOURSEATOM_SOCKET or a socket private to the user",
+    help="Unix socket to listen on",
+)
+def serve(ctx, socket_path):
+    """
+    Serve merges to `concmerge merge --server` from a long running process
+
+    Keeps the models imported and recent parsed inputs and merged outputs in memory
+    so repeated merges are fast. Requests are handled concurrently. Stop with Ctrl-C.
+    """
+    from concourseatom.server import MergeServer
+
+    with MergeServer(socket_path) as server:
+        click.echo(f"Serving merges on {socket_path}", err=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+@cli.command()
+@click.pass_context
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--deep", is_flag=True, help="Attempt to perform a deep merge of parallel elements"
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of worker processes [default: number of CPUs]",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Leave out fields that hold their default value",
+)
+@click.option(
+    "--trace",
+    "trace_file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write spans of each merge in every worker to this file as a Chrome trace",
+)
+def batch(ctx, manifest, deep, workers, compact, trace_file):
+    """
+    Merge many pipelines from a manifest in parallel
+
+    MANIFEST is a YAML file mapping each output pipeline to the list of snippets to
+    merge into it, in priority order. Paths are relative to the manifest. Each output
+    is merged in its own worker process and the timings for each are reported.
+
+    With --trace the phases of every merge are saved as one Chrome trace, with a
+    track for each worker process, to open in https://ui.perfetto.dev.
+    """
+    from concourseatom.batch import load_manifest, merge_batch
+
+    with traced(trace_file) as tracer:
+        results = merge_batch(
+            load_manifest(manifest),
+            deep=deep,
+            workers=workers,
+            compact=compact,
+            trace=tracer is not None,
+        )
+        if tracer is not None:
+            for result in results:
+                tracer.extend(result.trace_events)
+
+    for result in results:
+        click.echo(
+            f"{result.output}: {result.inputs} inputs"
+            f" parse {result.parse_seconds:.3f}s"
+            f" merge {result.merge_seconds:.3f}s"
+            f" write {result.write_seconds:.3f}s"
+        )
+
+
+@cli.command()
+@click.pass_context
+@click.option(
+    "--scale",
+    "scales",
+    type=click.IntRange(min=1),
+    multiple=True,
+    help="Number of jobs in each input, may be repeated [default: 10 and 100]",
+)
+@click.option(
+    "--phase",
+    "phases",
+    multiple=True,
+    help="Phase to run, may be repeated [default: all]",
+)
+@click.option(
+    "--runs",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Number of timed runs of each phase at each scale",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    default="-",
+    help="File to write the JSON results to [default: stdout]",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="JSON results of an earlier run to compare with",
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(min=0),
+    default=0.25,
+    show_default=True,
+    help="Fraction a phase may be slower or use more memory than the baseline",
+)
+def bench(ctx, scales, phases, runs, output, baseline, threshold):
+    """
+    Benchmark parsing, validating, merging, comparing and emitting pipelines
+
+    Each phase is run on synthetic pipelines at each scale and the operations per
+    second, median and 95th percentile times and peak memory are written out as
+    JSON. With --baseline the results are compared with an earlier run and the
+    command fails if any phase regressed by more than the threshold.
+    """
+    from concourseatom.bench import (
+        DEFAULT_SCALES,
+        PHASES,
+        compare,
+        dump_results,
+        load_results,
+        run_benchmarks,
+    )
+
+    unknown = [phase for phase in phases if phase not in PHASES]
+    if unknown:
+        raise click.BadParameter(
+            f"{', '.join(unknown)} not one of {', '.join(PHASES)}",
+            param_hint="--phase",
+        )
+
+    def on_result(result):
+        click.echo(
+            f"{result.phase} x{result.scale}: {result.ops_per_second:.3g} ops/s"
+            f" p50 {result.p50_seconds:.4f}s p95 {result.p95_seconds:.4f}s"
+            f" peak {result.peak_bytes / 1024:.0f}KiB",
+            err=True,
+        )
 
-    pipe0 = Pipeline.parse_raw(infile0)
-    pipe1 = Pipeline.parse_raw(infile1)
+    results = run_benchmarks(
+        scales or DEFAULT_SCALES, phases or None, runs, on_result=on_result
+    )
 
-    merge = Pipeline.merge(pipe0, pipe1)
+    with open_output(output) as out:
+        dump_results(results, out)
 
-    click.echo(merge.yaml())
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, load_results(f), threshold)
+        if regressions:
+            raise click.ClickException(
+                "Regressed from baseline:\n" + "\n".join(regressions)
+            )
+        click.echo("No regressions from baseline", err=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Record the phases of merges as spans in the Chrome trace event format
+
+A :class:`Tracer` installed with :func:`concourseatom.timing.phase_hook` records a
+complete event for every phase, nested within the phases around it. The trace is
+written as JSON that https://ui.perfetto.dev and ``chrome://tracing`` open directly.
+Events recorded in other processes, such as the workers of a batch, can be added to
+the trace so a whole run is shown on one timeline.
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, TextIO
+
+TraceEvent = Dict[str, Any]
+
+
+class Tracer:
+    """Hook recording each phase as a trace event
+
+    Phases are recorded when they end with the pid and thread that ran them and
+    their arguments. Use as the hook of :func:`concourseatom.timing.phase_hook`.
+    """
+
+    def __init__(self):
+        self.events: List[TraceEvent] = []
+
+    @contextmanager
+    def __call__(self, name: str, args: Dict[str, Any]):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": threading.get_native_id(),
+                    "args": args,
+                }
+            )
+
+    def extend(self, events: Iterable[TraceEvent]) -> None:
+        """Add events recorded by another tracer, such as in another process"""
+        self.events.extend(events)
+
+    def trace(self) -> Dict[str, Any]:
+        """The trace of the events, labelling each process by its pid"""
+        pids = sorted({event["pid"] for event in self.events})
+        this_pid = os.getpid()
+        names = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "args": {"name": "concmerge" if pid == this_pid else f"worker {pid}"},
+            }
+            for pid in pids
+        ]
+        return {"traceEvents": names + self.events, "displayTimeUnit": "ms"}
+
+    def write(self, stream: TextIO) -> None:
+        json.dump(self.trace(), stream, default=str)
+        stream.write("\n")
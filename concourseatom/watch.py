@@ -0,0 +1,74 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+"""Merge pipeline snippets again whenever one of them changes
+"""
+
+from __future__ import annotations
+import os
+import time
+from typing import Callable, List, Optional, Tuple
+
+from concourseatom.models import Pipeline
+from concourseatom.session import MergeSession
+
+
+def file_state(path: str) -> Optional[Tuple[int, int]]:
+    """Modification time and size of path, or None if it cannot be read"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def watch_merge(
+    paths: List[str],
+    on_merge: Callable[[Pipeline], None],
+    on_error: Callable[[str, Exception], None],
+    deep: bool = False,
+    loader: Callable[[bytes], Pipeline] = Pipeline.parse_raw,
+    interval: float = 1.0,
+    should_stop: Callable[[], bool] = lambda: False,
+) -> None:
+    """Merge files and merge them again each time one of them changes
+
+    Files are polled for changes to their modification time or size every interval
+    seconds. Only files that changed are parsed again and the merge is updated
+    incrementally by a :class:`MergeSession`. A file that fails to parse or merge is
+    reported to on_error and the last good version of it is kept until it changes
+    again.
+
+    :param paths: Files to merge in priority order
+    :param on_merge: Called with each merged pipeline
+    :param on_error: Called with the path and exception of each failure
+    :param deep: Deep merge jobs of the same name
+    :param loader: Parses the content of a file
+    :param interval: Seconds between polls
+    :param should_stop: Checked before each poll, watching ends when it returns True
+    """
+    states = [file_state(path) for path in paths]
+    pipelines = []
+    for path in paths:
+        with open(path, "rb") as f:
+            pipelines.append(loader(f.read()))
+    session = MergeSession(pipelines, deep)
+    on_merge(session.pipeline())
+
+    while not should_stop():
+        time.sleep(interval)
+
+        merged = False
+        for position, path in enumerate(paths):
+            state = file_state(path)
+            if state is None or state == states[position]:
+                continue
+            states[position] = state
+            try:
+                with open(path, "rb") as f:
+                    session.replace(position, loader(f.read()))
+            except Exception as e:
+                on_error(path, e)
+            else:
+                merged = True
+
+        if merged:
+            on_merge(session.pipeline())
@@ -0,0 +1,89 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+from dataclasses import replace
+import io
+import json
+import os
+
+from concourseatom.bench import (
+    PHASES,
+    BenchResult,
+    compare,
+    dump_results,
+    load_results,
+    run_benchmarks,
+)
+from concourseatom.tools import cli
+
+
+def test_run_benchmarks():
+    seen = []
+    results = run_benchmarks(scales=[2, 4], runs=2, on_result=seen.append)
+
+    assert results == seen
+    assert [(result.phase, result.scale) for result in results] == [
+        (phase, scale) for scale in [2, 4] for phase in PHASES
+    ]
+    for result in results:
+        assert result.runs == 2
+        assert result.ops_per_second > 0
+        assert 0 < result.p50_seconds <= result.p95_seconds
+        assert result.peak_bytes > 0
+
+    output = io.StringIO()
+    dump_results(results, output)
+    output.seek(0)
+    assert load_results(output) == results
+
+
+def test_compare():
+    base = BenchResult(
+        phase="merge",
+        scale=10,
+        runs=5,
+        ops_per_second=10,
+        p50_seconds=0.1,
+        p95_seconds=0.2,
+        peak_bytes=1024 * 1024,
+    )
+
+    assert compare([base], [base]) == []
+    assert compare([replace(base, p50_seconds=0.12)], [base], threshold=0.25) == []
+    assert compare([replace(base, scale=100, p50_seconds=1)], [base]) == []
+
+    (regression,) = compare([replace(base, p50_seconds=0.2)], [base], threshold=0.25)
+    assert "merge at scale 10: p50_seconds" in regression
+
+    (regression,) = compare([replace(base, peak_bytes=2 * 1024 * 1024)], [base])
+    assert "peak_bytes" in regression
+
+    # Large relative changes to very small measurements are noise
+    quick = replace(base, p50_seconds=0.00001, peak_bytes=100)
+    assert compare([replace(quick, p50_seconds=0.0001, peak_bytes=1000)], [quick]) == []
+
+
+def test_bench_cli(cli_runner, tmp_path):
+    output = os.path.join(tmp_path, "bench.json")
+    # Large enough that the merge is well above the noise in the measurements
+    options = ["bench", "--scale", "20", "--runs", "1", "--phase", "merge"]
+
+    result = cli_runner.invoke(cli, [*options, "-o", output])
+    assert result.exit_code == 0
+    with open(output) as f:
+        (merge,) = json.load(f)["results"]
+    assert (merge["phase"], merge["scale"]) == ("merge", 20)
+
+    result = cli_runner.invoke(
+        cli, [*options, "--baseline", output, "--threshold", "9"]
+    )
+    assert result.exit_code == 0
+
+    merge.update(p50_seconds=0, peak_bytes=0)
+    with open(output, "w") as f:
+        json.dump({"results": [merge]}, f)
+    result = cli_runner.invoke(cli, [*options, "--baseline", output])
+    assert result.exit_code == 1
+    assert "Regressed from baseline" in result.output
+
+    result = cli_runner.invoke(cli, ["bench", "--phase", "nothing"])
+    assert result.exit_code == 2
+    assert "nothing not one of parse" in result.output
@@ -0,0 +1,127 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+import os
+from textwrap import dedent
+import pytest
+
+from concourseatom.cache import MergeMemo, ParseCache
+from concourseatom.models import Pipeline
+
+
+def pipeline_bytes(name: str) -> bytes:
+    return dedent(
+        f"""
+        resources:
+        - name: src
+          type: time
+          source: {{}}
+        jobs:
+        - name: {name}
+          plan:
+          - get: src
+        """
+    ).encode()
+
+
+def test_ParseCache(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    calls = []
+
+    def loader(data):
+        calls.append(data)
+        return Pipeline.parse_raw(data)
+
+    data = pipeline_bytes("a")
+    first = cache.load(data, loader)
+    second = cache.load(data, loader)
+
+    assert calls == [data]
+    assert second.exactEq(first)
+    assert second.yaml() == first.yaml()
+    assert second.fingerprint() == first.fingerprint()
+
+    # A different loader is a different entry
+    cache.load(data, Pipeline.load_trusted)
+    assert len(os.listdir(tmp_path)) == 2
+
+    # Corrupt entries are discarded and reloaded
+    key = cache.key(data, loader)
+    with open(os.path.join(tmp_path, f"{key}.json"), "wb") as f:
+        f.write(b"not a pipeline")
+    assert cache.load(data, loader).exactEq(first)
+    assert len(calls) == 2
+
+
+def test_ParseCache_evict(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    data = [pipeline_bytes(name) for name in "abc"]
+    paths = [
+        os.path.join(tmp_path, f"{cache.key(item, Pipeline.parse_raw)}.json")
+        for item in data
+    ]
+    for index, (item, path) in enumerate(zip(data, paths)):
+        cache.load(item)
+        os.utime(path, (index, index))
+
+    # A hit makes the oldest entry the most recently used
+    cache.load(data[0])
+    cache.max_bytes = 2 * max(os.path.getsize(path) for path in paths)
+    cache.evict()
+
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+
+
+def test_ParseCache_unsafe_directory(tmp_path):
+    directory = os.path.join(tmp_path, "shared")
+    cache = ParseCache(directory)
+    cache.load(pipeline_bytes("a"))
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError, match="writable by other users"):
+        ParseCache(directory).load(pipeline_bytes("a"))
+
+
+def test_MergeMemo(monkeypatch):
+    memo = MergeMemo(maxsize=2)
+    pipelines = [Pipeline.parse_raw(pipeline_bytes(name)) for name in "abc"]
+
+    merged = memo.merge(pipelines[0], pipelines[1])
+    assert merged.exactEq(Pipeline.merge(pipelines[0], pipelines[1]))
+
+    calls = []
+    merge_many = Pipeline.merge_many.__func__
+
+    def counting_merge_many(cls, pipelines, deep=False):
+        calls.append(deep)
+        return merge_many(cls, pipelines, deep)
+
+    monkeypatch.setattr(Pipeline, "merge_many", classmethod(counting_merge_many))
+
+    # Equal inputs hit the cache, a different order or deep flag is a miss
+    copies = [Pipeline.parse_raw(pipeline_bytes(name)) for name in "ab"]
+    assert memo.merge_many(copies) is merged
+    assert calls == []
+    memo.merge(pipelines[1], pipelines[0])
+    memo.merge(pipelines[0], pipelines[1], deep=True)
+    assert calls == [False, True]
+
+    # Least recently used results are dropped beyond maxsize
+    memo.merge(pipelines[0], pipelines[1])
+    assert calls == [False, True, False]
+
+
+def test_MergeMemo_exact_content():
+    memo = MergeMemo()
+    pipeline = Pipeline.parse_raw(pipeline_bytes("a"))
+    with_hook = Pipeline.parse_raw(
+        pipeline_bytes("a") + b"  on_failure:\n    put: src\n"
+    )
+    # Equality ignores job hooks but the merged output does not
+    assert with_hook == pipeline
+
+    merged = memo.merge(pipeline, Pipeline())
+    merged_hook = memo.merge(with_hook, Pipeline())
+
+    assert merged_hook is not merged
+    assert merged_hook.jobs[0].on_failure is not None
+    assert merged_hook.yaml() == Pipeline.merge(with_hook, Pipeline()).yaml()
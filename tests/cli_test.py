@@ -1,11 +1,24 @@
 # concourseatom Copyright (C) 2022 Ben Greene
+import json
 import os
+import pstats
+import subprocess
+import sys
+from textwrap import dedent
 import click
 import pytest
 
+from concourseatom.models import Pipeline
 from concourseatom.tools import cli
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = os.path.join(tmp_path, "cache")
+    monkeypatch.setenv("CONCOURSEATOM_CACHE_DIR", cache_dir)
+    return cache_dir
+
+
 def test_cli(cli_runner):
     @click.command()
     @click.argument("name")
@@ -88,3 +101,397 @@ def test_merge_cli(cli_runner, request, filename0, filename1):
     print(result)
     assert result.exit_code == 0
     print(result.output)
+
+
+def test_merge_cli_many(cli_runner, request, tmp_path):
+    filenames = ["pipeline00.yaml", "pipeline01.yaml", "manually-triggered.yaml"]
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    files = [os.path.join(data_dir, filename) for filename in filenames]
+
+    result = cli_runner.invoke(cli, ["merge", *files])
+    assert result.exit_code == 0
+
+    pairwise = cli_runner.invoke(cli, ["merge", *files[:2]])
+    assert pairwise.exit_code == 0
+
+    pairwise_file = os.path.join(tmp_path, "pairwise.yaml")
+    with open(pairwise_file, "w") as f:
+        f.write(pairwise.output)
+    sequential = cli_runner.invoke(cli, ["merge", pairwise_file, files[2]])
+
+    assert sequential.exit_code == 0
+    assert result.output == sequential.output
+
+    trusted = cli_runner.invoke(cli, ["merge", "--trusted", pairwise_file, files[2]])
+
+    assert trusted.exit_code == 0
+    assert trusted.output == sequential.output
+
+
+def test_merge_cli_cache(cli_runner, request, cache_dir):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    files = [
+        os.path.join(data_dir, filename)
+        for filename in ["pipeline00.yaml", "pipeline01.yaml"]
+    ]
+
+    uncached = cli_runner.invoke(cli, ["merge", "--no-cache", *files])
+    assert uncached.exit_code == 0
+    assert not os.path.exists(cache_dir)
+
+    cached = cli_runner.invoke(cli, ["merge", *files])
+    assert cached.exit_code == 0
+    assert cached.output == uncached.output
+    entries = sorted(os.path.splitext(entry)[1] for entry in os.listdir(cache_dir))
+    assert entries == [".json", ".json", ".yaml"]
+
+    # The merged output is reused without parsing the inputs again
+    for entry in os.listdir(cache_dir):
+        if entry.endswith(".json"):
+            os.remove(os.path.join(cache_dir, entry))
+    cached = cli_runner.invoke(cli, ["merge", *files])
+    assert cached.exit_code == 0
+    assert cached.output == uncached.output
+    assert [os.path.splitext(entry)[1] for entry in os.listdir(cache_dir)] == [".yaml"]
+
+    deep = cli_runner.invoke(cli, ["merge", "--deep", *files])
+    assert deep.exit_code == 0
+    assert len(os.listdir(cache_dir)) == 4
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_batch_cli(cli_runner, request, tmp_path, workers):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    manifest = os.path.join(tmp_path, "manifest.yaml")
+    with open(manifest, "w") as f:
+        f.write(
+            dedent(
+                f"""
+                out0.yaml:
+                - {data_dir}/pipeline00.yaml
+                - {data_dir}/pipeline01.yaml
+                out1.yaml:
+                - {data_dir}/pipeline00.yaml
+                - {data_dir}/manually-triggered.yaml
+                """
+            )
+        )
+
+    result = cli_runner.invoke(cli, ["batch", manifest, "--workers", workers])
+    assert result.exit_code == 0
+    assert result.output.startswith(os.path.join(tmp_path, "out0.yaml"))
+
+    for output, inputs in [
+        ("out0.yaml", ["pipeline00.yaml", "pipeline01.yaml"]),
+        ("out1.yaml", ["pipeline00.yaml", "manually-triggered.yaml"]),
+    ]:
+        merged = cli_runner.invoke(
+            cli, ["merge", *(os.path.join(data_dir, input) for input in inputs)]
+        )
+        with open(os.path.join(tmp_path, output)) as f:
+            assert f.read() == merged.output
+
+
+def test_batch_cli_output_bytes(cli_runner, tmp_path):
+    inputs = []
+    for name in "ab":
+        path = os.path.join(tmp_path, f"{name}.yaml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(
+                dedent(
+                    f"""
+                    resources:
+                    - name: src
+                      type: time
+                      source: {{location: Zürich-{name}}}
+                    jobs: []
+                    """
+                )
+            )
+        inputs.append(path)
+    manifest = os.path.join(tmp_path, "manifest.yaml")
+    with open(manifest, "w") as f:
+        f.write(f"batch.yaml: [{inputs[0]}, {inputs[1]}]\n")
+    output = os.path.join(tmp_path, "merge.yaml")
+
+    result = cli_runner.invoke(cli, ["batch", manifest, "--workers", "1"])
+    assert result.exit_code == 0
+    result = cli_runner.invoke(cli, ["merge", "--no-cache", "-o", output, *inputs])
+    assert result.exit_code == 0
+
+    with open(os.path.join(tmp_path, "batch.yaml"), "rb") as f:
+        batch_bytes = f.read()
+    with open(output, "rb") as f:
+        assert f.read() == batch_bytes
+    assert "Zürich".encode() in batch_bytes
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("cache", [["--no-cache"], []])
+def test_merge_cli_output(cli_runner, request, tmp_path, cache, compact):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    files = [
+        os.path.join(data_dir, filename)
+        for filename in ["pipeline00.yaml", "manually-triggered.yaml"]
+    ]
+    output = os.path.join(tmp_path, "merged.yaml")
+    expected = Pipeline.merge_many([Pipeline.parse_file(file) for file in files])
+
+    options = [*cache, "--compact"] if compact else cache
+
+    # Run twice so the second is a cache hit when caching
+    for _ in range(2):
+        result = cli_runner.invoke(cli, ["merge", *options, "-o", output, *files])
+
+        assert result.exit_code == 0
+        assert result.output == ""
+        with open(output, newline="") as f:
+            if compact:
+                assert f.read() == expected.compact_yaml()
+            else:
+                assert f.read() == expected.yaml()
+
+
+def test_merge_cli_output_failed(cli_runner, request, tmp_path):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    invalid = os.path.join(tmp_path, "invalid.yaml")
+    with open(invalid, "w") as f:
+        f.write("jobs: 1\n")
+    output = os.path.join(tmp_path, "merged.yaml")
+    with open(output, "w") as f:
+        f.write("previous\n")
+    os.chmod(output, 0o640)
+
+    result = cli_runner.invoke(
+        cli,
+        ["merge", "-o", output, os.path.join(data_dir, "pipeline00.yaml"), invalid],
+    )
+
+    assert result.exit_code != 0
+    with open(output) as f:
+        assert f.read() == "previous\n"
+    assert sorted(os.listdir(tmp_path)) == ["cache", "invalid.yaml", "merged.yaml"]
+
+    files = [
+        os.path.join(data_dir, filename)
+        for filename in ["pipeline00.yaml", "manually-triggered.yaml"]
+    ]
+    result = cli_runner.invoke(cli, ["merge", "-o", output, *files])
+
+    assert result.exit_code == 0
+    assert os.stat(output).st_mode & 0o777 == 0o640
+
+
+@pytest.mark.parametrize("trusted", [[], ["--trusted"]])
+def test_merge_cli_json(cli_runner, request, tmp_path, trusted):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    pipelines = [
+        Pipeline.parse_file(os.path.join(data_dir, filename))
+        for filename in ["pipeline00.yaml", "manually-triggered.yaml"]
+    ]
+    files = []
+    for index, pipeline in enumerate(pipelines):
+        files.append(os.path.join(tmp_path, f"pipeline{index}.json"))
+        with open(files[-1], "w") as f:
+            f.write(pipeline.json())
+    expected = Pipeline.merge_many(pipelines)
+
+    result = cli_runner.invoke(cli, ["merge", *trusted, *files])
+    assert result.exit_code == 0
+    assert result.output == expected.yaml()
+
+    result = cli_runner.invoke(cli, ["merge", *trusted, "--format", "json", *files])
+    assert result.exit_code == 0
+    assert result.output == f"{expected.json()}\n"
+
+
+def test_merge_cli_profile(cli_runner, request, tmp_path):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    files = [
+        os.path.join(data_dir, filename)
+        for filename in ["pipeline00.yaml", "pipeline01.yaml"]
+    ]
+    output = os.path.join(tmp_path, "merged.yaml")
+
+    # Profiling does not use the cache so repeated runs still measure the merge
+    for _ in range(2):
+        result = cli_runner.invoke(cli, ["merge", "-o", output, *files, "--profile"])
+        assert result.exit_code == 0
+        phases = [line.split()[0] for line in result.output.splitlines()]
+        assert phases[:4] == ["phase", "total", "parse", "merge"]
+        assert "uniques_and_rewrites:Job" in phases
+        assert phases[-1] == "write"
+
+    pstats_file = os.path.join(tmp_path, "merge.pstats")
+    result = cli_runner.invoke(
+        cli,
+        [
+            "merge",
+            "--profile=cprofile",
+            "--profile-file",
+            pstats_file,
+            "-o",
+            output,
+            *files,
+        ],
+    )
+    assert result.exit_code == 0
+    assert pstats.Stats(pstats_file).total_calls > 0
+
+    result = cli_runner.invoke(cli, ["merge", "--profile", "--watch", *files])
+    assert result.exit_code == 2
+
+
+def test_merge_cli_trace(cli_runner, request, tmp_path):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    files = [
+        os.path.join(data_dir, filename)
+        for filename in ["pipeline00.yaml", "pipeline01.yaml"]
+    ]
+    trace_file = os.path.join(tmp_path, "trace.json")
+
+    # Tracing does not use the cache so repeated runs still trace the merge
+    for _ in range(2):
+        result = cli_runner.invoke(
+            cli, ["merge", "--deep", "--trace", trace_file, *files]
+        )
+        assert result.exit_code == 0
+        with open(trace_file) as f:
+            events = json.load(f)["traceEvents"]
+        names = {event["name"] for event in events if event["ph"] == "X"}
+        assert {"parse", "validate", "uniques_and_rewrites:Job", "write"} <= names
+
+    result = cli_runner.invoke(cli, ["merge", "--trace", trace_file, "--watch", *files])
+    assert result.exit_code == 2
+
+
+def test_merge_cli_memory_report(cli_runner, request, tmp_path):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    files = [
+        os.path.join(data_dir, filename)
+        for filename in ["pipeline00.yaml", "pipeline01.yaml"]
+    ]
+    output = os.path.join(tmp_path, "merged.yaml")
+
+    # Memory is not reported from the cache so repeated runs still measure the merge
+    for _ in range(2):
+        result = cli_runner.invoke(
+            cli, ["merge", "--memory-report", "-o", output, *files]
+        )
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert [line.split()[0] for line in lines[:4]] == [
+            "phase",
+            "total",
+            "parse",
+            "merge",
+        ]
+        models = lines[lines.index("") + 1 :]
+        assert models[0].split()[:4] == ["live", "models", "after", "merge"]
+        assert "Job" in [line.split()[0] for line in models]
+
+    result = cli_runner.invoke(cli, ["merge", "--memory-report", "--watch", *files])
+    assert result.exit_code == 2
+
+
+def test_batch_cli_trace(cli_runner, request, tmp_path):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+    manifest = os.path.join(tmp_path, "manifest.yaml")
+    with open(manifest, "w") as f:
+        f.write(
+            dedent(
+                f"""
+                out0.yaml:
+                - {data_dir}/pipeline00.yaml
+                - {data_dir}/pipeline01.yaml
+                out1.yaml:
+                - {data_dir}/pipeline00.yaml
+                - {data_dir}/manually-triggered.yaml
+                """
+            )
+        )
+    trace_file = os.path.join(tmp_path, "trace.json")
+
+    result = cli_runner.invoke(
+        cli, ["batch", manifest, "--workers", "2", "--trace", trace_file]
+    )
+    assert result.exit_code == 0
+    with open(trace_file) as f:
+        events = json.load(f)["traceEvents"]
+    batches = [event for event in events if event["name"] == "batch"]
+    assert sorted(os.path.basename(event["args"]["output"]) for event in batches) == [
+        "out0.yaml",
+        "out1.yaml",
+    ]
+    processes = {event["pid"] for event in events if event["name"] == "process_name"}
+    assert {event["pid"] for event in batches} <= processes
+
+
+def test_merge_cli_deep_output(cli_runner, tmp_path):
+    files = []
+    # Both jobs get src in parallel so the deep merge skips it once
+    for name, steps in [("a", "[get: src]"), ("b", "[get: src, get: other]")]:
+        path = os.path.join(tmp_path, f"{name}.yaml")
+        with open(path, "w") as f:
+            f.write(
+                dedent(
+                    f"""
+                    resources:
+                    - name: src
+                      type: time
+                      source: {{}}
+                    - name: other
+                      type: time
+                      source: {{interval: 1h}}
+                    jobs:
+                    - name: build
+                      plan:
+                      - in_parallel: {steps}
+                    """
+                )
+            )
+        files.append(path)
+
+    result = cli_runner.invoke(cli, ["merge", "--no-cache", "--deep", *files])
+
+    assert result.exit_code == 0
+    # Only the merged pipeline is written to stdout
+    merged = Pipeline.parse_raw(result.output)
+    (job,) = merged.jobs
+    assert [step.get for step in job.plan[0].in_parallel.steps] == ["src", "other"]
+
+
+def test_merge_cli_watch_needs_files(cli_runner, request):
+    data_dir = f"{os.path.splitext(request.module.__file__)[0]}-test_merge_cli"
+
+    result = cli_runner.invoke(
+        cli, ["merge", "--watch", os.path.join(data_dir, "pipeline00.yaml")]
+    )
+
+    assert result.exit_code == 2
+    assert "--watch needs two or more files" in result.output
+
+
+# Budget for the cumulative import time of concourseatom.tools, set well above the
+# ~50ms it takes without the models to keep the test reliable on slow machines
+IMPORT_BUDGET_US = 250_000
+
+
+def test_import_time(request):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import concourseatom.tools"],
+        cwd=os.path.dirname(os.path.dirname(request.module.__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines are "import time: self [us] | cumulative | imported package"
+    imports = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        imports[name.strip()] = int(cumulative)
+
+    heavy = ["pydantic", "pydantic_yaml", "ruamel.yaml", "concourseatom.models"]
+    assert [name for name in heavy if name in imports] == []
+    assert imports["concourseatom.tools"] < IMPORT_BUDGET_US
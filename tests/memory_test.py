@@ -0,0 +1,53 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+import tracemalloc
+
+from concourseatom.memory import MemoryTracker, live_models
+from concourseatom.models import Pipeline
+from concourseatom.synth import SynthConfig, synth_pipelines
+from concourseatom.timing import phase, phase_hook
+
+
+def test_live_models():
+    pipelines = synth_pipelines(2, SynthConfig(jobs=10, resources=5))
+    counts = live_models()
+    assert counts["Pipeline"] >= 2
+    assert counts["Job"] >= 20
+    assert counts["Resource"] >= 10
+    del pipelines
+
+
+def test_MemoryTracker():
+    tracker = MemoryTracker()
+    pipelines = synth_pipelines(
+        3, SynthConfig(jobs=10, resources=5, collision_rate=0.5, duplicate_rate=0.5)
+    )
+
+    tracemalloc.start()
+    try:
+        with phase_hook(tracker):
+            with phase("outer"):
+                kept = [bytearray(1024 * 1024)]
+                with phase("inner"):
+                    temporary = bytearray(2 * 1024 * 1024)
+                    del temporary
+                merged = Pipeline.merge_many(pipelines, deep=True)
+    finally:
+        tracemalloc.stop()
+
+    outer = tracker.stats[("outer",)]
+    inner = tracker.stats[("outer", "inner")]
+    assert inner.peak_bytes >= 2 * 1024 * 1024
+    assert inner.retained_bytes < 1024 * 1024
+    assert outer.peak_bytes >= inner.peak_bytes + 1024 * 1024
+    assert outer.retained_bytes >= 1024 * 1024
+    assert tracker.stats[("outer", "merge")].calls == 1
+
+    assert tracker.models["merge"]["Pipeline"] >= 4
+    assert tracker.models["merge"]["Job"] >= 30
+
+    lines = tracker.report().splitlines()
+    assert lines[0].split() == ["phase", "calls", "peak", "KiB", "retained", "KiB"]
+    assert lines[1].split()[:2] == ["outer", "1"]
+    assert lines[2].startswith("  inner")
+    assert any(line.startswith("live models after merge") for line in lines)
+    del kept, merged
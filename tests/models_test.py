@@ -2,6 +2,7 @@
 """Test functions for Concourse data models
 """
 from contextlib import nullcontext as does_not_raise
+from io import StringIO
 
 
 from typing import Any, Dict
@@ -16,17 +17,41 @@ from concourseatom.models import (
     Input,
     Job,
     LogRetentionPolicy,
+    NameRegistry,
     Output,
     Put,
     Resource,
     ResourceType,
+    RewriteVisitor,
     Task,
     TaskConfig,
+    get_uniquename,
 )
 from textwrap import dedent
+from pydantic import ValidationError
 import pytest
 
 
+@pytest.mark.parametrize(
+    "names, allocations",
+    [
+        ([], ["a"]),
+        (["a", "a-000", "a-002"], ["a", "a", "a", "b", "a"]),
+        (["a-001"], ["a", "a-000", "a", "a"]),
+    ],
+)
+def test_NameRegistry(names, allocations):
+    registry = NameRegistry(names)
+    namelist = list(names)
+
+    for name in allocations:
+        expected = get_uniquename(name, namelist)
+        namelist.append(expected)
+
+        assert registry.allocate(name) == expected
+        assert expected in registry
+
+
 def test_ResourceType():
     test0 = ResourceType(name="a", type="b", source={})
     assert test0 == ResourceType(name="a", type="b", source={})
@@ -142,6 +167,42 @@ def test_ResourceType():
                 "a": "a-001",
             },
         ),
+        (  # Map to item added earlier from the same list
+            [
+                ResourceType(name="a", type="b"),
+            ],
+            [
+                ResourceType(name="c", type="d"),
+                ResourceType(name="e", type="d"),
+            ],
+            [
+                ResourceType(name="a", type="b"),
+                ResourceType(name="c", type="d"),
+            ],
+            {
+                "c": "c",
+                "e": "c",
+            },
+        ),
+        (  # Map to first of several equal items
+            [
+                ResourceType(name="a", type="b"),
+                ResourceType(name="c", type="b"),
+            ],
+            [
+                ResourceType(name="e", type="b"),
+                ResourceType(name="c", type="f"),
+            ],
+            [
+                ResourceType(name="a", type="b"),
+                ResourceType(name="c", type="b"),
+                ResourceType(name="c-000", type="f"),
+            ],
+            {
+                "e": "a",
+                "c": "c-000",
+            },
+        ),
     ],
 )
 def test_ResourceType_uniques_rewrites(
@@ -311,6 +372,202 @@ def test_in_parallel():
     assert isinstance(test2.in_parallel.steps[0], Task)
 
 
+def test_step_dispatch():
+    job = Job.parse_raw(
+        dedent(
+            """
+            name: a
+            plan:
+            - in_parallel:
+              - do:
+                - put: b
+                - task: c
+                  config:
+                    platform: linux
+                    run:
+                      path: sh
+              - get: d
+            ensure:
+              put: e
+            """
+        )
+    )
+
+    steps = job.plan[0].in_parallel.steps
+    assert [type(step) for step in steps] == [Do, Get]
+    assert [type(step) for step in steps[0].do] == [Put, Task]
+    assert isinstance(job.ensure, Put)
+
+    with pytest.raises(ValidationError, match=r"plan -> 0 -> get"):
+        Job.parse_obj({"name": "a", "plan": [{"get": {}}]})
+
+
+def test_load_trusted():
+    text = dedent(
+        """
+        resources:
+        - name: d
+          type: git
+          source:
+            uri: repo
+        jobs:
+        - name: a
+          plan:
+          - in_parallel:
+            - do:
+              - put: b
+              - task: c
+                config:
+                  platform: linux
+                  run:
+                    path: sh
+            - get: d
+              trigger: true
+          - in_parallel:
+              steps:
+              - get: d
+              fail_fast: true
+          ensure:
+            put: e
+        """
+    )
+
+    expected = Pipeline.parse_raw(text)
+    trusted = Pipeline.load_trusted(text)
+
+    assert trusted.exactEq(expected)
+    assert trusted.yaml() == expected.yaml()
+    assert trusted.fingerprint() == expected.fingerprint()
+    assert isinstance(trusted.jobs[0].plan[0].in_parallel.steps[0], Do)
+    assert isinstance(trusted.jobs[0].ensure, Put)
+
+
+def test_compact_yaml():
+    text = dedent(
+        """
+        resource_types:
+        - name: e
+          type: registry-image
+          source:
+            repository: e-resource
+        resources:
+        - name: d
+          type: git
+          check_every: 10m
+          source:
+            uri: repo
+        jobs:
+        - name: a
+          serial: true
+          plan:
+          - in_parallel:
+              steps:
+              - get: d
+                trigger: false
+                passed: [b]
+              - task: c
+                config:
+                  platform: linux
+                  run:
+                    path: sh
+              fail_fast: true
+          ensure:
+            put: e
+        - name: b
+          plan:
+          - get: d
+        """
+    )
+
+    pipeline = Pipeline.parse_raw(text)
+    compact = pipeline.compact_yaml()
+    reparsed = Pipeline.parse_raw(compact)
+
+    assert reparsed.exactEq(pipeline)
+    assert reparsed.yaml() == pipeline.yaml()
+    assert len(compact) < len(pipeline.yaml()) / 2
+    assert "trigger" not in compact
+    assert "check_every: 10m" in compact
+    assert "fail_fast: true" in compact
+
+    output = StringIO()
+    pipeline.write_yaml(output, compact=True)
+    assert output.getvalue() == compact
+
+    assert Pipeline.parse_raw(Pipeline().compact_yaml()).exactEq(Pipeline())
+
+
+def test_parse_any(monkeypatch):
+    pipeline = Pipeline.parse_raw(
+        dedent(
+            """
+            resources:
+            - name: d
+              type: git
+              source:
+                uri: repo
+            jobs:
+            - name: a
+              plan:
+              - get: d
+                trigger: true
+              ensure:
+                put: e
+            """
+        )
+    )
+
+    # A YAML flow mapping looks like JSON but is not
+    flow = "{jobs: [{name: a, plan: [{get: d}]}]}"
+    assert Pipeline.parse_any(flow).exactEq(Pipeline.parse_raw(flow))
+
+    def no_yaml(b):
+        raise AssertionError("JSON was parsed as YAML")
+
+    monkeypatch.setattr(Pipeline.__config__, "yaml_loads", no_yaml)
+
+    for text in [pipeline.json(), f"\n  {pipeline.json()}".encode()]:
+        for load in [Pipeline.parse_any, Pipeline.load_trusted]:
+            parsed = load(text)
+            assert parsed.exactEq(pipeline)
+            assert parsed.json() == pipeline.json()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_write_json(compact):
+    pipeline = Pipeline.parse_raw(
+        dedent(
+            """
+            resources:
+            - name: d
+              type: git
+              source:
+                uri: repo
+            jobs:
+            - name: a
+              plan:
+              - in_parallel:
+                  steps:
+                  - get: d
+                  fail_fast: true
+            """
+        )
+    )
+
+    output = StringIO()
+    pipeline.write_json(output, compact)
+
+    if not compact:
+        assert output.getvalue() == f"{pipeline.json()}\n"
+    else:
+        assert "resource_types" not in output.getvalue()
+    assert Pipeline.parse_any(output.getvalue()).exactEq(pipeline)
+
+    output = StringIO()
+    Pipeline().write_json(output, compact)
+    assert Pipeline.parse_any(output.getvalue()).exactEq(Pipeline())
+
+
 @pytest.mark.parametrize(
     "myObj,rewrites,output, expectation",
     [
@@ -392,6 +649,169 @@ def test_rewrites(myObj: Any, rewrites: Dict[str, str], output: Any, expectation
         assert output == myObj.resource_rewrite(rewrites)
 
 
+@pytest.mark.parametrize(
+    "left, right",
+    [
+        (ResourceType(name="a", type="b"), ResourceType(name="c", type="b")),
+        (
+            Resource(name="a", type="b", source={"c": ["d"]}),
+            Resource(name="e", type="b", source={"c": ["d"]}),
+        ),
+        (Get(get="a"), Get(get="a", resource="a")),
+        (Put(put="a"), Put(put="a", resource="a")),
+        (
+            Task(
+                task="a",
+                config=TaskConfig(
+                    platform="linux", run=Command(path="sh"), inputs=[Input(name="a")]
+                ),
+                input_mapping={"a": "b"},
+            ),
+            Task(
+                task="a",
+                config=TaskConfig(
+                    platform="linux", run=Command(path="sh"), inputs=[Input(name="a")]
+                ),
+                input_mapping={"a": "b"},
+            ),
+        ),
+        (Do(do=[Get(get="a")]), Do(do=[Get(get="a", resource="a")])),
+        (
+            In_parallel(
+                in_parallel=In_parallel.Config(steps=[Get(get="a"), Put(put="b")])
+            ),
+            In_parallel(
+                in_parallel=In_parallel.Config(steps=[Put(put="b"), Get(get="a")])
+            ),
+        ),
+        (  # Steps with the same sort key in a different order
+            In_parallel(
+                in_parallel=In_parallel.Config(
+                    steps=[Get(get="a", trigger=True), Get(get="a")]
+                )
+            ),
+            In_parallel(
+                in_parallel=In_parallel.Config(
+                    steps=[Get(get="a"), Get(get="a", trigger=True)]
+                )
+            ),
+        ),
+        (Job(name="a", plan=[Get(get="b")]), Job(name="c", plan=[Get(get="b")])),
+        (
+            Pipeline(
+                resource_types=[ResourceType(name="a", type="b")],
+                jobs=[Job(name="c", plan=[Get(get="d")])],
+            ),
+            Pipeline(
+                resource_types=[ResourceType(name="a", type="b")],
+                jobs=[Job(name="c", plan=[Get(get="d", resource="d")])],
+            ),
+        ),
+    ],
+)
+def test_fingerprint(left: Any, right: Any):
+    assert left == right
+    assert hash(left) == hash(right)
+    assert len({left, right}) == 1
+
+
+def test_fingerprint_mismatch():
+    test0 = Job(
+        name="a",
+        plan=[In_parallel(in_parallel=In_parallel.Config(steps=[Get(get="a")]))],
+    )
+    test1 = Job(
+        name="a",
+        plan=[In_parallel(in_parallel=In_parallel.Config(steps=[Get(get="b")]))],
+    )
+    assert hash(test0) != hash(test1)
+    assert test0 != test1
+    assert Pipeline(jobs=[test0]) != Pipeline(jobs=[test1])
+
+
+def test_fingerprint_cache():
+    test0 = Get(get="a")
+    fingerprint = hash(test0)
+
+    test1 = test0.copy(update={"trigger": True})
+    assert hash(test1) != fingerprint
+    assert test0 != test1
+
+    test0.trigger = True
+    assert hash(test0) == hash(test1)
+    assert test0 == test1
+
+
+def test_rewrites_share_unchanged():
+    job = Job(
+        name="j",
+        plan=[
+            Get(get="a", resource="a"),
+            In_parallel(
+                in_parallel=In_parallel.Config(steps=[Get(get="b", resource="b")])
+            ),
+        ],
+        ensure=Put(put="a", resource="a"),
+    )
+    original = job.copy(deep=True)
+
+    assert job.resource_rewrite({"a": "a", "b": "b"}) is job
+    assert job.handle_rewrite({"a": "a", "b": "b"}) is job
+
+    rewritten = job.resource_rewrite({"a": "a", "b": "c"})
+    assert rewritten.plan[0] is job.plan[0]
+    assert rewritten.plan[1].in_parallel.steps[0] == Get(get="b", resource="c")
+    assert rewritten.ensure is job.ensure
+
+    assert job.exactEq(original)
+    assert job.yaml() == original.yaml()
+
+
+def test_RewriteVisitor():
+    job = Job(
+        name="j",
+        plan=[
+            Get(get="a"),
+            Do(
+                do=[
+                    Task(
+                        task="t",
+                        config=TaskConfig(
+                            platform="linux",
+                            run=Command(path="sh"),
+                            inputs=[Input(name="a")],
+                            outputs=[Output(name="b")],
+                        ),
+                    ),
+                    Put(put="b", resource="c"),
+                ]
+            ),
+        ],
+        on_failure=Put(put="d", resource="d"),
+    )
+
+    visitor = RewriteVisitor(
+        resource_rewrites={"a": "a-000", "c": "c", "d": "d"},
+        handle_rewrites={"a": "a", "b": "b-000", "d": "d"},
+        collect_handles=True,
+    )
+    rewritten = visitor.visit_job(job)
+
+    assert rewritten == job.resource_rewrite(visitor.resource_rewrites).handle_rewrite(
+        visitor.handle_rewrites
+    )
+    assert rewritten.plan[1].do[1] == Put(put="b-000", resource="c")
+    assert rewritten.on_failure is job.on_failure
+    assert visitor.handles == [
+        ("a", "a-000"),
+        ("a", None),
+        ("b", None),
+        ("b-000", "c"),
+    ]
+    assert rewritten.handles() == visitor.handles
+    assert job.handles() == [("a", "a"), ("a", None), ("b", None), ("b", "c")]
+
+
 @pytest.mark.parametrize(
     "myClass, myYaml",
     [
@@ -676,6 +1096,17 @@ def test_Job():
     assert test0 == test1
 
 
+def test_Job_deep_merge_hooks():
+    plan = [In_parallel(in_parallel=[Get(get="a")])]
+    hooked = Job(name="a", plan=plan, on_failure=Put(put="b"))
+
+    assert hooked.deep_merge(hooked.copy()) is hooked
+    with pytest.raises(Exception, match="different on_ tasks"):
+        hooked.deep_merge(Job(name="a", plan=plan))
+    with pytest.raises(Exception, match="different on_ tasks"):
+        Job(name="a", plan=plan).deep_merge(hooked)
+
+
 @pytest.mark.parametrize(
     "yaml_l, yaml_r, yaml_merged",
     [
@@ -1112,6 +1543,108 @@ def test_merge_pipelines(yaml_l, yaml_r, yaml_merged):
     assert merged_expected.exactEq(merged)
 
 
+def test_merge_skips_identity_rewrites(monkeypatch):
+    def fail_rewrite(self, resource_rewrites):
+        raise Exception(f"Unexpected rewrite {resource_rewrites}")
+
+    pipeline_left = Pipeline(
+        resource_types=[ResourceType(name="a", type="b")],
+        resources=[Resource(name="c", type="a", source={"d": "e"})],
+        jobs=[Job(name="f", plan=[Get(get="c")])],
+    )
+    pipeline_right = Pipeline(
+        resource_types=[ResourceType(name="g", type="h")],
+        resources=[Resource(name="i", type="g", source={"d": "e"})],
+        jobs=[Job(name="j", plan=[Get(get="i", resource="i")])],
+    )
+
+    monkeypatch.setattr(Resource, "resource_rewrite", fail_rewrite)
+    monkeypatch.setattr(Job, "resource_rewrite", fail_rewrite)
+
+    merged = Pipeline.merge(pipeline_left, pipeline_right)
+
+    assert [job.name for job in merged.jobs] == ["f", "j"]
+    assert merged.jobs[1] == pipeline_right.jobs[0]
+
+
+def test_merge_task_without_config():
+    pipeline_left = Pipeline(
+        resources=[Resource(name="r", type="time", source={"a": 1})],
+    )
+    pipeline_right = Pipeline(
+        resources=[Resource(name="r", type="time", source={"a": 2})],
+        jobs=[Job(name="j", plan=[Get(get="r"), Task(task="t", image="img")])],
+    )
+
+    merged = Pipeline.merge(pipeline_left, pipeline_right)
+
+    (job,) = merged.jobs
+    assert job.plan[0].effective_resource() == "r-000"
+    assert job.plan[1] == Task(task="t", image="img")
+    assert job.handles() == [("r", "r-000")]
+
+
+@pytest.mark.parametrize("resource", [None, "i"])
+def test_merge_identity_rewrites_output(monkeypatch, resource):
+    pipeline_left = Pipeline(
+        resource_types=[ResourceType(name="git", type="registry-image")],
+        resources=[Resource(name="c", type="git", source={"d": "e"})],
+        jobs=[Job(name="f", plan=[Get(get="c")])],
+    )
+    pipeline_right = Pipeline(
+        resource_types=[ResourceType(name="git", type="registry-image")],
+        resources=[Resource(name="i", type="git", source={"d": "g"})],
+        jobs=[
+            Job(
+                name="j",
+                plan=[Get(get="i", resource=resource)],
+                on_failure=Put(put="i", resource=resource),
+            )
+        ],
+    )
+
+    skipped = Pipeline.merge(pipeline_left, pipeline_right).yaml()
+    # The same merge with every rewrite applied, as when a resource is renamed
+    monkeypatch.setattr("concourseatom.models._is_identity", lambda rewrites: False)
+    rewritten = Pipeline.merge(pipeline_left, pipeline_right).yaml()
+
+    assert skipped == rewritten
+    assert "resource: i" in skipped
+
+
+@pytest.mark.parametrize("deep", [False, True])
+def test_merge_many(deep):
+    pipelines = [
+        Pipeline(
+            resource_types=[ResourceType(name="git", type="registry-image")],
+            resources=[
+                Resource(name="src", type="git", source={"uri": f"repo{index % 2}"})
+            ],
+            jobs=[
+                Job(
+                    name="build",
+                    plan=[
+                        In_parallel(
+                            in_parallel=In_parallel.Config(steps=[Get(get="src")])
+                        )
+                    ],
+                )
+            ],
+        )
+        for index in range(4)
+    ]
+
+    expected = pipelines[0]
+    for pipeline in pipelines[1:]:
+        expected = Pipeline.merge(expected, pipeline, deep)
+
+    merged = Pipeline.merge_many(pipelines, deep)
+
+    assert merged.yaml() == expected.yaml()
+    assert Pipeline.merge_many([]) == Pipeline()
+    assert Pipeline.merge_many(pipelines[:1]).exactEq(pipelines[0])
+
+
 @pytest.mark.parametrize(
     "yaml_l, yaml_r, yaml_merged",
     [
@@ -1501,6 +2034,50 @@ def test_Pipeline_load():
     print(f"Read as {test_a}")
 
 
+def test_Pipeline_exact_key():
+    pipeline = Pipeline.parse_raw(
+        dedent(
+            """
+            resources:
+            - name: a
+              type: time
+              source: {interval: 1}
+            - name: b
+              type: time
+              source: {}
+            jobs:
+            - name: j
+              plan:
+              - get: a
+            """
+        )
+    )
+    key = pipeline.exact_key()
+
+    # Fresh copies share the key, fingerprinting and merging change nothing
+    Pipeline.merge(pipeline, pipeline)
+    assert pipeline.exact_key() == key
+    assert Pipeline.load_trusted(pipeline.json()).exact_key() == key
+
+    # Changes that equality ignores but the output shows give different keys
+    reordered = pipeline.copy(update={"resources": pipeline.resources[::-1]})
+    assert reordered == pipeline
+    assert reordered.exact_key() != key
+    renamed = pipeline.copy(
+        update={"jobs": [pipeline.jobs[0].copy(update={"name": "k"})]}
+    )
+    assert renamed.exact_key() != key
+    retyped = pipeline.copy(
+        update={
+            "resources": [
+                pipeline.resources[0].copy(update={"source": {"interval": True}}),
+                pipeline.resources[1],
+            ]
+        }
+    )
+    assert retyped.exact_key() != key
+
+
 @pytest.mark.parametrize(
     "myyaml, valid",
     [
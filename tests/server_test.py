@@ -0,0 +1,150 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+from concourseatom.client import MergeServerError, default_socket_path, merge_remote
+from concourseatom.models import Pipeline
+from concourseatom.server import MergeServer
+from concourseatom.tools import cli
+
+
+@pytest.fixture
+def inputs(request):
+    data_dir = f"{os.path.dirname(request.module.__file__)}/cli_test-test_merge_cli"
+    filenames = ["pipeline00.yaml", "pipeline01.yaml", "manually-triggered.yaml"]
+    files = [os.path.join(data_dir, filename) for filename in filenames]
+    contents = []
+    for file in files:
+        with open(file, "rb") as f:
+            contents.append(f.read())
+    return files, contents
+
+
+@pytest.fixture
+def server():
+    # Unix socket paths are limited in length so keep out of the deep pytest paths
+    socket_dir = tempfile.mkdtemp(prefix="concourseatom-")
+    server = MergeServer(os.path.join(socket_dir, "merge.sock"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(socket_dir)
+
+
+def test_merge_remote(server, inputs):
+    _, contents = inputs
+    expected = [
+        Pipeline.merge_many([Pipeline.parse_raw(data) for data in contents[:count]])
+        for count in (2, 3)
+    ]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        merged = list(
+            executor.map(
+                lambda count: merge_remote(
+                    contents[:count], socket_path=server.server_address
+                ),
+                [2, 3] * 4,
+            )
+        )
+
+    assert merged == [pipeline.yaml() for pipeline in expected] * 4
+    assert len(server.merged) == 2
+    assert len(server.parsed) == 3
+
+    merged = merge_remote(
+        contents, socket_path=server.server_address, output_format="json"
+    )
+    assert merged == f"{expected[1].json()}\n"
+
+    with pytest.raises(MergeServerError, match="ValidationError"):
+        merge_remote([b"jobs: [{}]"], socket_path=server.server_address)
+
+    with pytest.raises(Exception, match="already listening"):
+        MergeServer(server.server_address)
+
+
+def test_merge_cli_server(cli_runner, server, inputs):
+    files, _ = inputs
+
+    local = cli_runner.invoke(cli, ["merge", "--no-cache", *files])
+    remote = cli_runner.invoke(
+        cli, ["merge", "--server", server.server_address, *files]
+    )
+
+    assert remote.exit_code == 0
+    assert remote.output == local.output
+
+    compact = cli_runner.invoke(
+        cli, ["merge", "--compact", "--server", server.server_address, *files]
+    )
+
+    assert compact.exit_code == 0
+    assert compact.output == Pipeline.parse_raw(local.output).compact_yaml()
+    assert len(compact.output) < len(local.output)
+
+    missing = cli_runner.invoke(
+        cli, ["merge", "--server", f"{server.server_address}.missing", *files]
+    )
+    assert missing.exit_code == 1
+    assert "failed" in missing.output
+
+
+def test_MergeServer_socket_path(server):
+    # A second server refuses to take over a live socket
+    with pytest.raises(Exception, match="already listening"):
+        MergeServer(server.server_address)
+
+    socket_dir = tempfile.mkdtemp(prefix="concourseatom-")
+    try:
+        # Anything other than a socket is left alone
+        path = os.path.join(socket_dir, "pipeline.yaml")
+        with open(path, "w") as f:
+            f.write("jobs: []\n")
+        with pytest.raises(Exception, match="not a socket"):
+            MergeServer(path)
+        with open(path) as f:
+            assert f.read() == "jobs: []\n"
+
+        # A stale socket is replaced
+        stale = MergeServer(os.path.join(socket_dir, "merge.sock"))
+        stale.socket.close()
+        MergeServer(stale.server_address).server_close()
+    finally:
+        shutil.rmtree(socket_dir)
+
+
+def test_default_socket_path(tmp_path, monkeypatch):
+    monkeypatch.delenv("CONCOURSEATOM_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    assert default_socket_path() == os.path.join(tmp_path, "concourseatom.sock")
+
+    # Without a runtime dir the socket is in a directory private to the user
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    path = default_socket_path()
+    directory = os.path.dirname(path)
+    assert os.path.dirname(directory) == str(tmp_path)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert default_socket_path() == path
+
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError, match="private"):
+        default_socket_path()
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="Needs root to give the socket away")
+def test_merge_remote_other_user(server, inputs):
+    _, contents = inputs
+    os.chown(server.server_address, 65534, -1)
+
+    with pytest.raises(PermissionError, match="another user"):
+        merge_remote(contents, socket_path=server.server_address)
+    assert len(server.merged) == 0
@@ -0,0 +1,119 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+from dataclasses import replace
+import random
+
+import pytest
+
+from concourseatom.models import Get, Job, Pipeline, Resource, ResourceType
+from concourseatom.session import MergeSession
+from concourseatom.synth import SynthConfig, synth_pipeline
+
+
+@pytest.mark.parametrize("deep", [False, True])
+def test_MergeSession(deep):
+    def snippet(job, uri, resource="src"):
+        return Pipeline(
+            resource_types=[ResourceType(name="git", type="registry-image")],
+            resources=[Resource(name=resource, type="git", source={"uri": uri})],
+            jobs=[Job(name=job, plan=[Get(get=resource)])],
+        )
+
+    pipelines = [
+        snippet("a", "repo0"),
+        snippet("b", "repo1"),
+        snippet("c", "repo2", "other"),
+        snippet("d", "repo1"),
+    ]
+    session = MergeSession(pipelines, deep)
+    assert len(session) == 4
+    assert session.pipeline().yaml() == Pipeline.merge_many(pipelines, deep).yaml()
+
+    # Renames src of b and d from src-000 to src, c is unaffected
+    pipelines[0] = snippet("a", "repo1")
+    session.replace(0, pipelines[0])
+    assert session.recomputed == [0, 1, 3]
+    assert session.pipeline().yaml() == Pipeline.merge_many(pipelines, deep).yaml()
+
+    pipelines[2] = snippet("c", "repo3", "other")
+    session.replace(-2, pipelines[2])
+    assert session.recomputed == [2]
+    assert session.pipeline().yaml() == Pipeline.merge_many(pipelines, deep).yaml()
+
+    pipelines.append(snippet("e", "repo4"))
+    session.append(pipelines[-1])
+    assert session.recomputed == [4]
+    assert session.pipeline().yaml() == Pipeline.merge_many(pipelines, deep).yaml()
+
+    if deep:
+        # A failed deep merge leaves the session unchanged
+        with pytest.raises(Exception, match="deep_merge"):
+            session.replace(1, snippet("a", "repo5"))
+        assert session.pipeline().yaml() == Pipeline.merge_many(pipelines, deep).yaml()
+
+    assert MergeSession().pipeline() == Pipeline()
+
+
+@pytest.mark.parametrize("deep", [False, True])
+def test_MergeSession_random(deep):
+    config = SynthConfig(
+        resource_types=2, resources=4, jobs=4, collision_rate=0.8, duplicate_rate=0.5
+    )
+    rng = random.Random(5)
+
+    def snippet():
+        return synth_pipeline(replace(config, seed=rng.randrange(50)))
+
+    pipelines = [snippet() for _ in range(6)]
+    while True:
+        try:
+            session = MergeSession(pipelines, deep)
+            break
+        except Exception:
+            pipelines = [snippet() for _ in range(6)]
+
+    failed = 0
+    for _ in range(20):
+        position = rng.randrange(len(pipelines))
+        pipeline = snippet()
+        candidate = pipelines.copy()
+        candidate[position] = pipeline
+        try:
+            expected = Pipeline.merge_many(candidate, deep)
+        except Exception:
+            # A failed update leaves the session merging the inputs from before it
+            with pytest.raises(Exception):
+                session.replace(position, pipeline)
+            failed += 1
+        else:
+            session.replace(position, pipeline)
+            pipelines = candidate
+            assert session.pipeline().json() == expected.json()
+        assert session.pipeline().json() == Pipeline.merge_many(pipelines, deep).json()
+
+    assert failed or not deep
+
+
+def test_MergeSession_allocate():
+    def snippet(uri):
+        return Pipeline(
+            resource_types=[ResourceType(name="git", type="registry-image")],
+            resources=[Resource(name="src", type="git", source={"uri": uri})],
+            jobs=[Job(name="build", plan=[Get(get="src")])],
+        )
+
+    pipelines = [snippet(f"repo{index}") for index in range(6)]
+    # Takes the name that the next allocation for src would otherwise get
+    pipelines[3].resources.append(
+        Resource(name="src-003", type="git", source={"uri": "other"})
+    )
+    session = MergeSession(pipelines)
+    assert session.pipeline().json() == Pipeline.merge_many(pipelines).json()
+
+    # Frees src-000, the allocations after it must move down
+    pipelines[1] = snippet("repo0")
+    session.replace(1, pipelines[1])
+    assert session.pipeline().json() == Pipeline.merge_many(pipelines).json()
+
+    pipelines[1] = snippet("repo1")
+    session.replace(1, pipelines[1])
+    assert session.pipeline().json() == Pipeline.merge_many(pipelines).json()
@@ -0,0 +1,64 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+import pytest
+
+from concourseatom.models import Do, In_parallel, Pipeline
+from concourseatom.synth import SynthConfig, synth_data, synth_pipeline, synth_pipelines
+
+
+def plan_depth(step) -> int:
+    if isinstance(step, Do):
+        return 1 + max(plan_depth(child) for child in step.do)
+    if isinstance(step, In_parallel):
+        return 1 + max(plan_depth(child) for child in step.in_parallel.steps)
+    return 0
+
+
+def test_synth_pipeline():
+    config = SynthConfig(
+        resource_types=3, resources=10, jobs=20, plan_steps=3, max_depth=2, seed=7
+    )
+    pipeline = synth_pipeline(config)
+
+    assert pipeline.validate()
+    assert len(pipeline.resource_types) == 3
+    assert len(pipeline.resources) == 10
+    assert len(pipeline.jobs) == 20
+    assert all(len(job.plan) == 3 for job in pipeline.jobs)
+    assert max(plan_depth(step) for job in pipeline.jobs for step in job.plan) <= 2
+    assert Pipeline.parse_raw(pipeline.yaml()).exactEq(pipeline)
+
+    assert synth_data(config) == synth_data(config)
+    assert synth_data(config) != synth_data(SynthConfig(seed=8))
+
+    flat = synth_pipeline(SynthConfig(jobs=5, nesting_rate=0))
+    assert all(plan_depth(step) == 0 for job in flat.jobs for step in job.plan)
+
+
+def test_synth_pipeline_empty():
+    assert synth_pipeline(SynthConfig(resource_types=0, resources=0)).exactEq(
+        Pipeline()
+    )
+    assert synth_pipeline(SynthConfig(resource_types=0, resources=2)).validate()
+
+
+@pytest.mark.parametrize("deep", [False, True])
+def test_synth_pipelines(deep):
+    config = SynthConfig(jobs=30, resources=10, collision_rate=0, duplicate_rate=0)
+    pipelines = synth_pipelines(3, config)
+    merged = Pipeline.merge_many(pipelines, deep=deep)
+
+    # Nothing is shared so nothing is combined
+    assert len(merged.resources) == 30
+    assert len(merged.jobs) == 90
+
+    config = SynthConfig(jobs=30, resources=10, collision_rate=0.5, duplicate_rate=0.5)
+    pipelines = synth_pipelines(3, config)
+    merged = Pipeline.merge_many(pipelines, deep=deep)
+
+    assert len(merged.resources) < 30
+    names = {job.name for pipeline in pipelines for job in pipeline.jobs}
+    assert len(names) < 90
+    if deep:
+        assert len(merged.jobs) < 90
+    else:
+        assert len(merged.jobs) == 90
@@ -0,0 +1,115 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+from contextlib import contextmanager
+import threading
+
+from concourseatom.models import Pipeline
+from concourseatom.synth import SynthConfig, synth_pipelines
+from concourseatom.timing import (
+    PhaseTimer,
+    format_table,
+    phase,
+    phase_hook,
+    tree_order,
+)
+
+
+def in_thread():
+    with phase("thread"):
+        pass
+
+
+def test_phase_hook():
+    seen = []
+
+    @contextmanager
+    def record(name, counts):
+        seen.append(("start", name, counts))
+        yield
+        seen.append(("end", name, counts))
+
+    with phase("unhooked"):
+        pass
+
+    with phase_hook(record):
+        with phase("a", items=1):
+            with phase("b"):
+                pass
+
+        # Hooks only apply to the thread that installed them
+        other_thread = threading.Thread(target=in_thread)
+        other_thread.start()
+        other_thread.join()
+
+        timer = PhaseTimer()
+        with phase_hook(timer):
+            with phase("c"):
+                pass
+        with phase("d"):
+            pass
+
+    with phase("unhooked"):
+        pass
+
+    assert [(event, name) for event, name, _ in seen] == [
+        ("start", "a"),
+        ("start", "b"),
+        ("end", "b"),
+        ("end", "a"),
+        ("start", "c"),
+        ("end", "c"),
+        ("start", "d"),
+        ("end", "d"),
+    ]
+    assert seen[0][2] == {"items": 1}
+    assert list(timer.stats) == [("c",)]
+
+
+def test_PhaseTimer():
+    timer = PhaseTimer()
+    pipelines = synth_pipelines(
+        3, SynthConfig(jobs=10, resources=5, collision_rate=0.5, duplicate_rate=0.5)
+    )
+
+    with phase_hook(timer):
+        for _ in range(2):
+            Pipeline.merge_many(pipelines, deep=True)
+
+    merge = timer.stats[("merge",)]
+    assert merge.calls == 2
+    assert merge.counts == {"pipelines": 6}
+    assert timer.stats[("merge", "validate")].calls == 2
+    jobs = timer.stats[("merge", "uniques_and_rewrites:Job")]
+    assert jobs.calls == 4
+    assert jobs.counts == {"items": 40}
+    assert ("merge", "uniques_and_rewrites:Job", "deep_merge") in timer.stats
+    assert merge.seconds >= jobs.seconds > 0
+
+    lines = timer.report().splitlines()
+    assert lines[0].split() == ["phase", "calls", "seconds", "items"]
+    assert lines[1].split()[:2] == ["merge", "2"]
+    assert lines[1].split()[3] == "pipelines=6"
+    assert lines[2].split()[:2] == ["validate", "2"]
+    assert lines[2].startswith("  validate")
+
+
+def test_tree_order():
+    paths = [("b", "c"), ("a",), ("b",), ("a", "d"), ("b", "c", "e")]
+
+    # Parents end, and so are recorded, after their children
+    assert tree_order(paths) == [
+        ("a",),
+        ("a", "d"),
+        ("b",),
+        ("b", "c"),
+        ("b", "c", "e"),
+    ]
+
+
+def test_format_table():
+    rows = [("phase", "calls", "items"), ("merge", "12", ""), ("  parse", "3", "a=1")]
+
+    assert format_table(rows, "<><") == [
+        "phase    calls  items",
+        "merge       12",
+        "  parse      3  a=1",
+    ]
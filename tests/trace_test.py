@@ -0,0 +1,46 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+from io import StringIO
+import json
+import os
+
+from concourseatom.models import Pipeline
+from concourseatom.synth import SynthConfig, synth_pipelines
+from concourseatom.timing import phase, phase_hook
+from concourseatom.trace import Tracer
+
+
+def test_Tracer():
+    tracer = Tracer()
+    pipelines = synth_pipelines(
+        3, SynthConfig(jobs=10, resources=5, collision_rate=0.5, duplicate_rate=0.5)
+    )
+
+    with phase_hook(tracer):
+        with phase("outer", label="merges"):
+            Pipeline.merge_many(pipelines, deep=True)
+
+    # Events are recorded as they end so the outermost comes last
+    outer = tracer.events[-1]
+    assert outer["name"] == "outer"
+    assert outer["ph"] == "X"
+    assert outer["pid"] == os.getpid()
+    assert outer["args"] == {"label": "merges"}
+    for event in tracer.events:
+        assert outer["ts"] <= event["ts"]
+        assert event["ts"] + event["dur"] <= outer["ts"] + outer["dur"]
+
+    rewrites = [event for event in tracer.events if event["name"] == "rewrite"]
+    # Each job of the snippets after the first is rewritten
+    assert len(rewrites) == 20
+    assert all("job" in event["args"] for event in rewrites)
+    assert any(event["name"] == "deep_merge" for event in tracer.events)
+
+    tracer.extend([dict(outer, pid=outer["pid"] + 1)])
+    output = StringIO()
+    tracer.write(output)
+    trace = json.loads(output.getvalue())
+    assert trace["displayTimeUnit"] == "ms"
+    names = [event for event in trace["traceEvents"] if event["ph"] == "M"]
+    assert [event["pid"] for event in names] == [os.getpid(), os.getpid() + 1]
+    assert names[0]["args"] == {"name": "concmerge"}
+    assert len(trace["traceEvents"]) == len(tracer.events) + 2
@@ -0,0 +1,132 @@
+# concourseatom Copyright (C) 2022 Ben Greene
+from dataclasses import replace
+import os
+from textwrap import dedent
+
+from concourseatom.models import Pipeline
+from concourseatom.synth import SynthConfig, synth_pipeline
+from concourseatom.watch import watch_merge
+
+
+def write_pipeline(path, uri):
+    with open(path, "w") as f:
+        f.write(
+            dedent(
+                f"""
+                resource_types:
+                - name: git
+                  type: registry-image
+                resources:
+                - name: src
+                  type: git
+                  source:
+                    uri: {uri}
+                jobs:
+                - name: build-{uri}
+                  plan:
+                  - get: src
+                """
+            )
+        )
+
+
+def test_watch_merge(tmp_path):
+    paths = [os.path.join(tmp_path, f"{name}.yaml") for name in "ab"]
+    write_pipeline(paths[0], "repo0")
+    write_pipeline(paths[1], "repo1")
+
+    def merged():
+        return Pipeline.merge_many([Pipeline.parse_file(path) for path in paths]).yaml()
+
+    expected = [merged()]
+
+    def change_b():
+        write_pipeline(paths[1], "repo-changed")
+        expected.append(merged())
+
+    def break_a():
+        with open(paths[0], "a") as f:
+            f.write("jobs: [\n")
+
+    def fix_a():
+        write_pipeline(paths[0], "repo1")
+        expected.append(merged())
+
+    # Each poll follows the next edit, watching stops when they run out
+    edits = [change_b, lambda: None, break_a, fix_a]
+
+    def should_stop():
+        if not edits:
+            return True
+        edits.pop(0)()
+        return False
+
+    outputs = []
+    errors = []
+    watch_merge(
+        paths,
+        lambda merged: outputs.append(merged.yaml()),
+        lambda path, e: errors.append(path),
+        interval=0.01,
+        should_stop=should_stop,
+    )
+
+    assert outputs == expected
+    assert errors == [paths[0]]
+
+
+def test_watch_merge_failed_merge(tmp_path):
+    config = SynthConfig(
+        resource_types=2, resources=4, jobs=4, collision_rate=0.8, duplicate_rate=0.5
+    )
+    seeds = [34, 25, 30, 17, 1, 23]
+    paths = [os.path.join(tmp_path, f"{index}.json") for index in range(len(seeds))]
+
+    def write_seed(path, seed):
+        with open(path, "w") as f:
+            f.write(synth_pipeline(replace(config, seed=seed)).json())
+
+    for path, seed in zip(paths, seeds):
+        write_seed(path, seed)
+
+    def merged():
+        pipelines = [Pipeline.parse_file(path) for path in paths]
+        return Pipeline.merge_many(pipelines, deep=True).json()
+
+    expected = [merged()]
+    good = {}
+
+    def break_merge():
+        # Parses but cannot be deep merged with the other inputs
+        with open(paths[2]) as f:
+            good["2"] = f.read()
+        write_seed(paths[2], 34)
+
+    def fix_merge():
+        with open(paths[2], "w") as f:
+            f.write(good["2"])
+        write_seed(paths[4], 32)
+        expected.append(merged())
+
+    edits = [break_merge, fix_merge]
+
+    def should_stop():
+        if not edits:
+            return True
+        edits.pop(0)()
+        return False
+
+    outputs = []
+    errors = []
+    watch_merge(
+        paths,
+        lambda merged: outputs.append(merged.json()),
+        lambda path, e: errors.append(path),
+        deep=True,
+        loader=Pipeline.parse_any,
+        interval=0.01,
+        should_stop=should_stop,
+    )
+
+    assert errors == [paths[2]]
+    assert outputs == expected